@@ -1,39 +1,270 @@
+import os
+import sys
+import time
+import multiprocessing as mp
 import pandas as pd
-from sqlalchemy import create_engine
-from services.isochrone_service import IsochroneService
-from conf import DB_URL
+from sqlalchemy import create_engine, text, inspect
+from services.isochrone_service import IsochroneService, as_thresholds
+from services.isochrone_cache import IsochroneCache
+from services.work_queue import WorkQueue, LeaseLost
+from services.osrm_hints import HintCache
+from conf import (
+    DB_URL, OSRM_WALK_URL, OSRM_MAX_TABLE_SIZE, OSRM_MAX_IN_FLIGHT,
+    OSRM_DATA_DIR, ISOCHRONE_CACHE_PATH, WORK_QUEUE_PATH, CATCHMENT_WORKERS,
+    HINT_CACHE_PATH, MAX_SNAP_M
+)
+
+# Hexágonos por unidad de trabajo (lo que se pierde como mucho si un proceso muere)
+UNIT_SIZE = 500
+REPORT_EVERY_S = 30
+
+# Tipos de trabajo: polígono de isócrona o conjunto de celdas H3 alcanzables
+TIPOS = ("poligonos", "celdas")
+
+def _job_name(tipo, ciudad, thresholds):
+    return f"{tipo}:{ciudad}:{'_'.join(map(str, thresholds))}"
+
+def _parse_job(job):
+    tipo, ciudad, mins = job.split(":")
+    return tipo, ciudad, [int(m) for m in mins.split("_")]
+
+def _tabla(tipo, thresholds):
+    if tipo == "celdas":
+        return "catchment_cells"
+    return f"catchment_{'_'.join(map(str, thresholds))}m"
+
+# Columnas de las tablas destino (las mismas que crearía CopyWriter con el primer lote)
+_COLUMNAS = {
+    "poligonos": "h3_id TEXT, minutes INTEGER, geometry geometry(Polygon, 4326)",
+    "celdas": "h3_id TEXT, minutes INTEGER, n_cells INTEGER, cells BIGINT[]",
+}
+
+def _crear_tabla(engine, tipo, thresholds):
+    """
+    Crea la tabla destino con un índice único (h3_id, minutes): si dos workers llegan a
+    escribir la misma unidad (lease caducado), las filas repetidas se descartan al escribir.
+    En tablas de ejecuciones anteriores se borran antes los duplicados que pudiera haber.
+    """
+    table_name = _tabla(tipo, thresholds)
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS core.{table_name} ({_COLUMNAS[tipo]});"))
+        exists = conn.execute(text("SELECT to_regclass(:name)"), {"name": f"core.uq_{table_name}_h3"}).scalar()
+        if exists is None:
+            conn.execute(text(f"""
+                DELETE FROM core.{table_name} a USING core.{table_name} b
+                WHERE a.h3_id = b.h3_id AND a.minutes = b.minutes AND a.ctid > b.ctid;
+            """))
+            conn.execute(text(f"CREATE UNIQUE INDEX uq_{table_name}_h3 ON core.{table_name} (h3_id, minutes);"))
+        # El índice único sustituye al que tenía core.catchment_cells
+        conn.execute(text(f"DROP INDEX IF EXISTS core.idx_{table_name}_h3;"))
+
+# Hexágonos que no se rutan (centroide a más de MAX_SNAP_M de la red): no se vuelven a encolar
+TABLA_DESCARTES = "catchment_skipped"
+
+def _crear_tabla_descartes(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS core.{TABLA_DESCARTES} (
+                h3_id TEXT PRIMARY KEY,
+                reason TEXT,
+                snap_m DOUBLE PRECISION,
+                created_at TIMESTAMP DEFAULT now()
+            );
+        """))
+
+def _marcar_descartes(engine, skipped):
+    """skipped: [(h3_id, snap_m)] de los orígenes que IsochroneService omite por snapear lejos."""
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            INSERT INTO core.{TABLA_DESCARTES} (h3_id, reason, snap_m) VALUES (:h3_id, 'snap_far', :snap_m)
+            ON CONFLICT (h3_id) DO UPDATE SET reason = EXCLUDED.reason, snap_m = EXCLUDED.snap_m, created_at = now();
+        """), [{"h3_id": h, "snap_m": snap_m} for h, snap_m in skipped])
+
+def _pendientes(engine, tipo, ciudad, thresholds):
+    """
+    Anti-join: hexágonos de la ciudad que aún no tienen catchment guardado ni están
+    marcados como descartados (snap_far).
+    """
+    table_name = _tabla(tipo, thresholds)
+    if not inspect(engine).has_table(table_name, schema="core"):
+        join, where = "", ""
+    else:
+        # Todos los umbrales de un origen se guardan juntos: basta con mirar el mayor
+        on_minutes = f" AND c.minutes = {thresholds[-1]}" if tipo == "celdas" else ""
+        join = f"LEFT JOIN core.{table_name} c ON h.h3_id = c.h3_id{on_minutes}"
+        where = "AND c.h3_id IS NULL"
 
-def mapear_ciudad_completa(ciudad, mins):
-    engine = create_engine(DB_URL)
-    service = IsochroneService(DB_URL)
-    
-    # Buscamos hexágonos sin procesar en core
     query = f"""
-        SELECT h.h3_id, ST_Y(ST_Centroid(h.geometry)) as lat, ST_X(ST_Centroid(h.geometry)) as lon 
+        SELECT h.h3_id, ST_Y(ST_Centroid(h.geometry)) as lat, ST_X(ST_Centroid(h.geometry)) as lon
         FROM core.hexagons h
-        LEFT JOIN core.catchment_{mins}m c ON h.h3_id = c.h3_id
-        WHERE h.city = '{ciudad}' AND c.h3_id IS NULL
+        {join}
+        LEFT JOIN core.{TABLA_DESCARTES} s ON h.h3_id = s.h3_id
+        WHERE h.city = '{ciudad}' {where} AND s.h3_id IS NULL
+    """
+    return pd.read_sql(query, engine)
+
+def _ya_guardados(engine, tipo, thresholds, ids):
     """
-    df = pd.read_sql(query, engine)
-    
+    Ids de la unidad que ya están en la tabla destino: si un proceso murió entre el INSERT
+    y el marcador de completado, al reanudar no se duplican filas.
+    """
+    table_name = _tabla(tipo, thresholds)
+    if not inspect(engine).has_table(table_name, schema="core"):
+        return set()
+    on_minutes = f" AND minutes = {thresholds[-1]}" if tipo == "celdas" else ""
+    df = pd.read_sql(
+        text(f"SELECT DISTINCT h3_id FROM core.{table_name} WHERE h3_id = ANY(:ids){on_minutes}"),
+        engine, params={"ids": list(ids)}
+    )
+    return set(df["h3_id"])
+
+def planificar(queue, engine, tipo, ciudad, mins, unit_size=UNIT_SIZE):
+    """
+    Mete en la cola los hexágonos pendientes del trabajo. Si el trabajo ya tiene unidades
+    abiertas (ejecución anterior interrumpida) se reanuda tal cual, sin volver a consultar.
+    """
+    thresholds = as_thresholds(mins)
+    job = _job_name(tipo, ciudad, thresholds)
+    if queue.has_open_units(job):
+        print(f"♻️ {job}: reanudando unidades pendientes de la ejecución anterior.")
+        return job
+
+    _crear_tabla(engine, tipo, thresholds)
+    _crear_tabla_descartes(engine)
+    df = _pendientes(engine, tipo, ciudad, thresholds)
     if df.empty:
-        print(f"✅ {ciudad} ya está procesada para {mins} min.")
-        return
-
-    # Procesamos por bloques para no saturar OSRM
-    batch_size = 500
-    for i in range(0, len(df), batch_size):
-        batch = df.iloc[i : i + batch_size]
-        puntos = [{'id': r['h3_id'], 'lat': r['lat'], 'lon': r['lon']} for _, r in batch.iterrows()]
-        
-        service.calculate_and_save(
-            puntos, 
-            minutes=mins, 
-            table_name=f"catchment_{mins}m", 
-            schema="core", 
-            id_column="h3_id"
-        )
-        print(f"📦 Progreso {ciudad}: {i+len(batch)}/{len(df)}")
+        print(f"✅ {ciudad} ya está procesada ({tipo}, {mins} min).")
+        return job
+
+    items = df[["h3_id", "lat", "lon"]].values.tolist()
+    n_units = queue.enqueue(job, items, unit_size)
+    print(f"🗂️ {job}: {len(items)} hexágonos en {n_units} unidades.")
+    return job
+
+def _worker(jobs, worker_name, max_in_flight):
+    """Proceso consumidor: pide unidades a la cola hasta que no queda ninguna."""
+    worker_name = f"{worker_name}@{os.getpid()}"
+    queue = WorkQueue(WORK_QUEUE_PATH)
+    engine = create_engine(DB_URL)
+    service = IsochroneService(
+        DB_URL,
+        osrm_url=OSRM_WALK_URL,
+        max_table_size=OSRM_MAX_TABLE_SIZE,
+        max_in_flight=max_in_flight,
+        cache=IsochroneCache(ISOCHRONE_CACHE_PATH, OSRM_DATA_DIR, profile="foot"),
+        hints=HintCache(HINT_CACHE_PATH, OSRM_DATA_DIR, profile="foot"),
+        max_snap_m=MAX_SNAP_M
+    )
+
+    while True:
+        leased = queue.lease(jobs, worker_name)
+        if leased is None:
+            break
+        job, unit, items, attempts = leased
+        tipo, ciudad, thresholds = _parse_job(job)
+
+        def latido(job=job, unit=unit):
+            # Tras cada lote escrito: la unidad sigue siendo nuestra mientras avance
+            if not queue.renew(job, unit, worker_name):
+                raise LeaseLost(f"{job} unidad {unit}: el lease caducó y la tiene otro worker")
+
+        descartar = lambda skipped: _marcar_descartes(engine, skipped)
+
+        try:
+            done = _ya_guardados(engine, tipo, thresholds, [h for h, _, _ in items])
+            puntos = [{'id': h, 'lat': lat, 'lon': lon} for h, lat, lon in items if h not in done]
+            if puntos and tipo == "celdas":
+                service.calculate_cells_and_save(puntos, minutes=thresholds, table_name="catchment_cells", schema="core", id_column="h3_id",
+                                                 skip_conflicts=True, heartbeat=latido, on_skip=descartar)
+            elif puntos:
+                service.calculate_and_save(puntos, minutes=thresholds, table_name=_tabla(tipo, thresholds), schema="core", id_column="h3_id",
+                                           skip_conflicts=True, heartbeat=latido, on_skip=descartar)
+            if not queue.complete(job, unit, worker_name):
+                print(f"⚠️ [{worker_name}] {job} unidad {unit}: el lease caducó y la tiene otro worker.")
+        except LeaseLost as e:
+            print(f"⚠️ [{worker_name}] {e}")
+        except Exception as e:
+            print(f"⚠️ [{worker_name}] {job} unidad {unit} (intento {attempts + 1}): {e}")
+            queue.fail(job, unit, worker_name, e)
+    queue.close()
+
+def _informe(queue, jobs, t0, done0):
+    progress = queue.progress(jobs)
+    done = sum(p.get("done", (0, 0))[1] for p in progress.values())
+    total = sum(items for p in progress.values() for _, items in p.values())
+    failed = sum(p.get("failed", (0, 0))[1] for p in progress.values())
+
+    elapsed = time.time() - t0
+    rate = (done - done0) / elapsed if elapsed > 0 else 0
+    remaining = total - done - failed
+    eta = f"{remaining / rate / 60:.1f} min" if rate > 0 else "?"
+    print(f"📦 {done}/{total} hexágonos | {rate:.1f} hex/s | ETA {eta}" + (f" | ❌ {failed} fallidos" if failed else ""))
+    for job, p in progress.items():
+        job_total = sum(items for _, items in p.values())
+        if job_total:
+            print(f"   · {job}: {p.get('done', (0, 0))[1]}/{job_total}")
+    return done
+
+def ejecutar_trabajos(trabajos, workers=CATCHMENT_WORKERS, unit_size=UNIT_SIZE):
+    """
+    trabajos: [(tipo, ciudad, mins)], tipo en TIPOS. Todos se reparten en la misma cola y
+    los consumen 'workers' procesos a la vez (varias ciudades/umbrales en paralelo).
+    Si se interrumpe, relanzar con los mismos trabajos continúa donde se quedó.
+    """
+    engine = create_engine(DB_URL)
+    queue = WorkQueue(WORK_QUEUE_PATH)
+    jobs = []
+    for tipo, ciudad, mins in trabajos:
+        if tipo not in TIPOS:
+            raise ValueError(f"tipo debe ser uno de {TIPOS}")
+        jobs.append(planificar(queue, engine, tipo, ciudad, mins, unit_size))
+    # Unidades que dejó a medias una ejecución anterior que murió
+    queue.reclaim_orphans(jobs)
+
+    t0 = time.time()
+    done0 = _informe(queue, jobs, t0, 0)
+    # El límite de peticiones en vuelo contra OSRM es global: se reparte entre procesos
+    max_in_flight = max(1, OSRM_MAX_IN_FLIGHT // workers)
+    procs = [
+        mp.Process(target=_worker, args=(jobs, f"w{i}", max_in_flight), daemon=True)
+        for i in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    next_id = workers
+
+    while any(p.is_alive() for p in procs):
+        for p in procs:
+            p.join(timeout=REPORT_EVERY_S / len(procs))
+        caidos = queue.reclaim_orphans(jobs)
+        if caidos:
+            # Procesos que murieron con una unidad a medias: se completa el pool con nuevos
+            print(f"⚠️ {caidos} worker(s) caído(s), relanzando sus unidades...")
+            procs = [p for p in procs if p.is_alive()]
+            while len(procs) < workers:
+                procs.append(mp.Process(target=_worker, args=(jobs, f"w{next_id}", max_in_flight), daemon=True))
+                procs[-1].start()
+                next_id += 1
+        _informe(queue, jobs, t0, done0)
+
+    print(f"🏁 Terminado en {(time.time() - t0) / 60:.1f} min.")
+    queue.close()
+
+def mapear_ciudad_completa(ciudad, mins, workers=CATCHMENT_WORKERS):
+    """
+    mins: un umbral (15) o varios ([5, 10, 15]). Con varios, los anillos salen del mismo
+    pase de rutado y van todos a core.catchment_5_10_15m (columna minutes).
+    """
+    ejecutar_trabajos([("poligonos", ciudad, mins)], workers=workers)
+
+def mapear_celdas_ciudad(ciudad, mins, workers=CATCHMENT_WORKERS):
+    """
+    Igual que mapear_ciudad_completa pero guarda el catchment como celdas H3
+    alcanzables (core.catchment_cells) en lugar de polígono.
+    """
+    ejecutar_trabajos([("celdas", ciudad, mins)], workers=workers)
 
 if __name__ == "__main__":
-    mapear_ciudad_completa("MADRID", mins=15)
\ No newline at end of file
+    # Uso: python batch_compute_city_catchments.py [CIUDAD ...]  (por defecto MADRID, 15 min)
+    ciudades = sys.argv[1:] or ["MADRID"]
+    ejecutar_trabajos([("poligonos", c, 15) for c in ciudades])
@@ -13,6 +13,34 @@ DB_CONNECTION_STR = DB_URL
 # Servidor OSRM local (Docker)
 OSRM_WALK_URL = "http://localhost:5001"
 
+# Límite de /table de osrm-routed (--max-table-size, 100 por defecto).
+# Si se sube en docker-compose, subirlo aquí también para que los lotes sean más grandes.
+OSRM_MAX_TABLE_SIZE = 100
+
+# Peticiones simultáneas contra OSRM (igualar a los threads de osrm-routed, -t)
+OSRM_MAX_IN_FLIGHT = 8
+
+# Datos procesados de OSRM (su huella invalida la caché de isócronas al regenerarlos)
+OSRM_DATA_DIR = "docker/osrm_data"
+ISOCHRONE_CACHE_PATH = "data/cache/isochrones.sqlite"
+
+# Hints de /nearest (dónde snapea cada centroide/POI). Los puntos que snapean a más de
+# MAX_SNAP_M de la red se marcan y no se rutan (evita timeouts en zonas sin calles).
+HINT_CACHE_PATH = "data/cache/osrm_hints.sqlite"
+MAX_SNAP_M = 300
+
+# Grafos peatonales locales (backend 'graph', sin OSRM), uno por ciudad: data/graphs/<CIUDAD>_foot
+GRAPH_DIR = "data/graphs"
+
+# Matriz de tiempos andando hexágono -> hexágono (res 9), una por ciudad: data/walk_matrix/<CIUDAD>
+WALK_MATRIX_DIR = "data/walk_matrix"
+WALK_MATRIX_RADIUS_M = 1500
+
+# Cola de trabajo del cálculo masivo de catchments (reanudable) y procesos que la consumen.
+# Los OSRM_MAX_IN_FLIGHT se reparten entre los procesos.
+WORK_QUEUE_PATH = "data/cache/work_queue.sqlite"
+CATCHMENT_WORKERS = 4
+
 # ==========================================
 # 2. PARÁMETROS TÉCNICOS Y RUTAS
 # ==========================================
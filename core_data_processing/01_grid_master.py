@@ -1,11 +1,8 @@
 import sys
 import os
-import h3
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Polygon, box, mapping
 from sqlalchemy import create_engine, text, inspect
-from rasterstats import zonal_stats  # <--- NECESARIO: pip install rasterstats
 
 # 1. Configuración de rutas
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -19,6 +16,9 @@ except ImportError:
     print("❌ Error: No se encuentra 'conf.py'.")
     sys.exit(1)
 
+from services.h3_grid import city_grid
+from services.h3_raster import aggregate_raster
+
 # --- CONFIGURACIÓN RASTER ---
 # Ajusta el nombre si tu archivo se llama diferente
 GHS_FILENAME = "GHS_BUILT_S_E1975_GLOBE_R2023A_4326_3ss_V1_0.tif"
@@ -47,26 +47,13 @@ def filter_by_urban_footprint(df_hex, city_name):
         print(f"      ⚠️ Raster GHS no encontrado en {GHS_PATH}. Saltando filtro poblacional.")
         return df_hex
 
-    # 2. Convertir a GeoDataFrame si no lo es (necesario para zonal_stats)
-    if not isinstance(df_hex, gpd.GeoDataFrame):
-        gdf_temp = gpd.GeoDataFrame(df_hex, geometry='geometry', crs="EPSG:4326")
-    else:
-        gdf_temp = df_hex
-
     print(f"      🏘️ Filtrando zonas deshabitadas (Raster GHS)...")
     
-    # 3. Zonal Stats: Sumamos el valor de píxeles construidos dentro del hexágono
+    # 2. Sumamos el valor de los píxeles construidos cuyo centro cae en cada hexágono
     try:
-        stats = zonal_stats(
-            vectors=gdf_temp['geometry'], 
-            raster=GHS_PATH, 
-            stats=['sum']
-        )
-        
-        # Asignamos score (0 si es None)
-        df_hex['built_up_score'] = [x['sum'] if x['sum'] is not None else 0 for x in stats]
+        df_hex['built_up_score'] = aggregate_raster(GHS_PATH, df_hex['h3_id'], 'sum').values
         
-        # 4. FILTRO: Score > 50 (Umbral empírico de zona urbana)
+        # 3. FILTRO: Score > 50 (Umbral empírico de zona urbana)
         # Esto elimina hexágonos en medio del bosque o mar
         df_filtered = df_hex[df_hex['built_up_score'] > 50].copy()
         
@@ -107,27 +94,14 @@ def generate_master_grid():
             continue
             
         print(f"   📍 Generando Hexágonos para: {city}...")
-        coords = CITY_BBOXES[city]
+        # IDs H3 + geometría (necesaria para el filtro raster) de una vez, como arrays
+        grid = city_grid(city, CITY_BBOXES[city], H3_RESOLUTION)
         
-        # Generar Polígono BBOX
-        city_polygon = box(coords['min_lon'], coords['min_lat'], coords['max_lon'], coords['max_lat'])
-        geo_json = mapping(city_polygon)
-        
-        # Generar IDs H3
-        hex_ids = h3.polyfill(geo_json, H3_RESOLUTION, geo_json_conformant=True)
-        
-        if not hex_ids:
+        if not len(grid):
             print(f"      ⚠️ Zona vacía o muy pequeña para resolución {H3_RESOLUTION}.")
             continue
 
-        # Crear DF temporal
-        df_city = pd.DataFrame(list(hex_ids), columns=['h3_id'])
-        df_city['city'] = city
-        
-        # Generar geometría (Necesaria para el filtro raster)
-        df_city['geometry'] = df_city['h3_id'].apply(
-            lambda x: Polygon(h3.h3_to_geo_boundary(x, geo_json=True))
-        )
+        df_city = grid.frame("h3_id", geometry=True, city=city)[['h3_id', 'city', 'geometry']]
         
         print(f"      ⬡ Hexágonos brutos generados: {len(df_city)}")
 
@@ -1,12 +1,12 @@
 import sys
 import os
-import gc
 import re
 import glob
-import geopandas as gpd
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import rasterio
 from sqlalchemy import create_engine, text
-from rasterstats import zonal_stats
 
 # 1. Configuración de rutas
 DEMOGRAPHICS_DIR = "/home/jesus/spatia-li/data/raw/worldpop_parts"
@@ -15,13 +15,20 @@ if BASE_DIR not in sys.path:
     sys.path.insert(0, BASE_DIR)
 
 try:
-    from conf import DB_URL, ACTIVE_CITIES
+    from conf import DB_URL, ACTIVE_CITIES, CITY_BBOXES
 except ImportError:
     print("❌ Error: No se encuentra 'conf.py'.")
     sys.exit(1)
 
+from services.h3_raster import pixel_mapping
+from services.copy_writer import CopyWriter
+
 SCHEMA = "core"
 TABLE = "demographics"
+YEAR = 2025
+
+# Bandas que se leen/agregan a la vez (rasterio suelta el GIL al leer)
+RASTER_WORKERS = min(8, os.cpu_count() or 1)
 
 def parse_filename_r2025(filename):
     """Analiza el nombre del archivo para extraer género y edad."""
@@ -43,8 +50,9 @@ def parse_filename_r2025(filename):
         
     return f"pop_{gender_label}_{age_label}"
 
-def ensure_column_exists(engine, column_name):
-    """Asegura la tabla y la columna."""
+def ensure_columns(engine, columns):
+    """Asegura la tabla y todas las columnas de población (+ p_t) en una sola sentencia."""
+    adds = ",\n".join(f"ADD COLUMN IF NOT EXISTS {c} FLOAT DEFAULT 0" for c in [*columns, "p_t"])
     with engine.connect() as conn:
         conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA};"))
         conn.execute(text(f"""
@@ -54,66 +62,63 @@ def ensure_column_exists(engine, column_name):
                 year INTEGER
             );
         """))
-        try:
-            conn.execute(text(f"ALTER TABLE {SCHEMA}.{TABLE} ADD COLUMN IF NOT EXISTS {column_name} FLOAT DEFAULT 0;"))
-            conn.commit()
-        except: pass
-
-def calculate_total_population(engine, columns):
-    """Suma todas las columnas de población en una nueva columna p_t."""
-    if not columns: return
-    
-    print(f"\n🧮 Calculando columna P_T (Suma de {len(columns)} franjas)...")
-    
-    # Construimos la parte de la suma: col1 + col2 + col3...
-    sum_expression = " + ".join([f"COALESCE({col}, 0)" for col in columns])
-    
+        conn.execute(text(f"ALTER TABLE {SCHEMA}.{TABLE} {adds};"))
+        conn.commit()
+
+def _grid_key(src):
+    return (tuple(src.transform)[:6], src.width, src.height, src.crs.to_string() if src.crs else None)
+
+def city_frame(h3_ids, bands):
+    """
+    Frame ancho (h3_id, pop_..., p_t) de una ciudad. El mapeo píxel -> celda se calcula una
+    vez por rejilla (todas las bandas de WorldPop comparten la misma) y cada banda se reduce
+    contra él en un pool de hilos.
+    """
+    mappings = {}
+    with rasterio.open(bands[0][0]) as src:
+        mappings[_grid_key(src)] = pixel_mapping(src, h3_ids)
+
+    def reduce_band(band):
+        file_path, column_name = band
+        with rasterio.open(file_path) as src:
+            key = _grid_key(src)
+            if key not in mappings:
+                # Rejilla distinta (raro en WorldPop): su propio mapeo
+                mappings[key] = pixel_mapping(src, h3_ids)
+            mapping = mappings[key]
+            data = src.read(1, window=mapping.window, masked=True)
+        return column_name, mapping.aggregate(data, "sum")
+
+    df = pd.DataFrame({"h3_id": h3_ids})
+    with ThreadPoolExecutor(max_workers=RASTER_WORKERS) as pool:
+        for column_name, values in pool.map(reduce_band, bands):
+            df[column_name] = values
+    df["p_t"] = df[[c for _, c in bands]].sum(axis=1)
+    return df
+
+def upsert_city(engine, city, df):
+    """Todas las columnas de la ciudad de una vez: COPY a una tabla temporal + un único upsert."""
+    temp_table = f"temp_dm_{city.lower()}"
+    columns = [c for c in df.columns if c != "h3_id"]
     with engine.connect() as conn:
-        # 1. Crear columna p_t si no existe
-        conn.execute(text(f"ALTER TABLE {SCHEMA}.{TABLE} ADD COLUMN IF NOT EXISTS p_t FLOAT DEFAULT 0;"))
-        
-        # 2. Realizar el update masivo
-        sql = f"UPDATE {SCHEMA}.{TABLE} SET p_t = {sum_expression};"
-        conn.execute(text(sql))
+        conn.execute(text(f"DROP TABLE IF EXISTS {SCHEMA}.{temp_table};"))
         conn.commit()
-    
-    print("   ✅ Columna P_T actualizada correctamente.")
 
-def process_single_raster(engine, file_path, column_name):
-    """Proceso individual por raster y ciudad."""
-    print(f"\n📊 Procesando: {column_name}")
-    ensure_column_exists(engine, column_name)
+    with CopyWriter(engine, temp_table, schema=SCHEMA, constants={"city": city, "year": YEAR}) as writer:
+        writer.write(df.to_dict("records"))
 
-    for city in ACTIVE_CITIES:
-        print(f"   ↳ {city}...", end='\r')
-        sql = text(f"SELECT h3_id, geometry FROM {SCHEMA}.hexagons WHERE city = :city")
-        gdf_hex = gpd.read_postgis(sql, engine, params={"city": city}, geom_col="geometry")
-        if gdf_hex.empty: continue
+    all_columns = ["h3_id", "city", "year", *columns]
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in all_columns[1:])
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            INSERT INTO {SCHEMA}.{TABLE} ({", ".join(all_columns)})
+            SELECT {", ".join(all_columns)} FROM {SCHEMA}.{temp_table}
+            ON CONFLICT (h3_id) DO UPDATE SET {updates};
+        """))
+        conn.execute(text(f"DROP TABLE {SCHEMA}.{temp_table};"))
+        conn.commit()
 
-        stats = zonal_stats(vectors=gdf_hex['geometry'], raster=file_path, stats=['sum'])
-        gdf_hex[column_name] = [x['sum'] if x['sum'] is not None else 0 for x in stats]
-        
-        temp_table = f"temp_dm_{city.lower()}"
-        gdf_hex[['h3_id', column_name]].to_sql(temp_table, engine, if_exists='replace', index=False)
-
-        with engine.connect() as conn:
-            conn.execute(text(f"""
-                INSERT INTO {SCHEMA}.{TABLE} (h3_id, city, year)
-                SELECT h3_id, '{city}', 2025 FROM {temp_table}
-                ON CONFLICT (h3_id) DO NOTHING;
-            """))
-            conn.execute(text(f"""
-                UPDATE {SCHEMA}.{TABLE} AS target
-                SET {column_name} = source.{column_name}
-                FROM {temp_table} AS source
-                WHERE target.h3_id = source.h3_id;
-            """))
-            conn.execute(text(f"DROP TABLE {temp_table};"))
-            conn.commit()
-        del gdf_hex
-        gc.collect()
-
-def main():
+def main(cities):
     engine = create_engine(DB_URL)
     raster_files = glob.glob(os.path.join(DEMOGRAPHICS_DIR, "*.tif"))
     
@@ -123,21 +128,35 @@ def main():
 
     print(f"📂 Encontrados {len(raster_files)} archivos de población R2025A.")
     
-    processed_columns = []
-
-    # 1. Procesar cada archivo
+    # 1. Bandas reconocidas (fichero, columna)
+    bands = []
     for file_path in sorted(raster_files):
         col_name = parse_filename_r2025(os.path.basename(file_path))
         if col_name:
-            process_single_raster(engine, file_path, col_name)
-            processed_columns.append(col_name)
+            bands.append((file_path, col_name))
         else:
             print(f"⚠️ Ignorado: {os.path.basename(file_path)}")
-
-    # 2. NUEVO: Calcular el total después de procesar todo
-    calculate_total_population(engine, processed_columns)
+    if not bands:
+        return
+    ensure_columns(engine, [c for _, c in bands])
+
+    # 2. Una pasada por ciudad: mapeo una vez, todas las bandas, un upsert (con p_t)
+    for city in cities:
+        t0 = time.time()
+        sql = text(f"SELECT h3_id FROM {SCHEMA}.hexagons WHERE city = :city")
+        h3_ids = pd.read_sql(sql, engine, params={"city": city})['h3_id'].tolist()
+        if not h3_ids:
+            print(f"   ⚠️ {city} no tiene hexágonos en {SCHEMA}.hexagons. Saltando.")
+            continue
+
+        print(f"\n📊 {city}: {len(bands)} bandas sobre {len(h3_ids)} hexágonos...")
+        df = city_frame(h3_ids, bands)
+        upsert_city(engine, city, df)
+        print(f"   ✅ {len(df)} hexágonos, P_T total {df['p_t'].sum():,.0f} ({time.time() - t0:.1f}s)")
 
     print("\n🏁 PROCESO COMPLETADO. Datos e índice P_T generados.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Uso: python core_data_processing/04_population_wordlpop.py [CIUDAD ...]
+    targets = sys.argv[1:] or ACTIVE_CITIES or list(CITY_BBOXES.keys())
+    main(targets)
@@ -0,0 +1,100 @@
+import sys
+import os
+import time
+import h3
+import pandas as pd
+from sqlalchemy import create_engine, text, inspect
+
+# 1. Configuración de rutas
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+try:
+    from conf import DB_URL, CITY_BBOXES, ACTIVE_CITIES, H3_RESOLUTION
+except ImportError:
+    print("❌ Error: No se encuentra 'conf.py'.")
+    sys.exit(1)
+
+from services.grid_distance import distance_fields
+
+# Distancias aproximadas a la instalación más cercana por saltos en la malla H3 (sin OSRM).
+# Pensado para cribado a escala nacional: una pasada O(N) por categoría y ciudad.
+SCHEMA = "core"
+TABLE = "grid_distance_features"
+
+# Mismas categorías que etl/01_build_dataset.py
+CATEGORY_MAP = {
+    'Cafetería': 'cafe', 'Bar': 'cafe', 'Panadería': 'cafe', 'Restaurante': 'cafe',
+    'Gimnasio': 'gym', 'Tienda de ropa': 'shop', 'Centro comercial': 'shop', 'Tienda de deportes': 'shop'
+}
+
+def get_grid(engine, city):
+    df = pd.read_sql(text("SELECT h3_id FROM core.hexagons WHERE city = :city"), engine, params={"city": city})
+    return df['h3_id'].tolist()
+
+def get_seed_points(engine, city):
+    """{categoría: DataFrame(lat, lon)} con POIs comerciales y paradas de transporte."""
+    categories_sql = "', '".join(CATEGORY_MAP.keys())
+    df_pois = pd.read_sql(f"""
+        SELECT latitude AS lat, longitude AS lon, search_category
+        FROM public.retail_poi_master
+        WHERE UPPER(city) LIKE '%%{city.upper()}%%'
+          AND search_category IN ('{categories_sql}')
+    """, engine)
+    df_pois['cat'] = df_pois['search_category'].map(CATEGORY_MAP)
+    points = {cat: df_pois[df_pois['cat'] == cat] for cat in ('cafe', 'gym', 'shop')}
+
+    bbox = CITY_BBOXES[city]
+    points['transit'] = pd.read_sql(f"""
+        SELECT ST_Y(geometry) AS lat, ST_X(geometry) AS lon FROM osm_transport_points
+        WHERE geometry && ST_MakeEnvelope({bbox['min_lon']}, {bbox['min_lat']}, {bbox['max_lon']}, {bbox['max_lat']}, 4326)
+    """, engine)
+    return points
+
+def build_city(engine, city):
+    grid = get_grid(engine, city)
+    if not grid:
+        print(f"   ⚠️ {city} no tiene hexágonos en core.hexagons. Saltando.")
+        return None
+
+    points = get_seed_points(engine, city)
+    seeds = {}
+    for cat, df in points.items():
+        # Semilla = celda que contiene al menos un POI de la categoría
+        seeds[cat] = {h3.geo_to_h3(lat, lon, H3_RESOLUTION) for lat, lon in zip(df['lat'], df['lon'])}
+        print(f"      📍 {cat}: {len(df)} puntos -> {len(seeds[cat])} celdas semilla")
+
+    df_out = distance_fields(grid, seeds, res=H3_RESOLUTION).reset_index()
+    df_out.insert(1, 'city', city)
+    return df_out
+
+def main(cities):
+    engine = create_engine(DB_URL)
+    for city in cities:
+        if city not in CITY_BBOXES:
+            print(f"⚠️ La ciudad {city} no tiene configuración en conf.py. Saltando.")
+            continue
+
+        print(f"\n🏙️  Campos de distancia H3 para {city}...")
+        t0 = time.time()
+        df_out = build_city(engine, city)
+        if df_out is None:
+            continue
+
+        # Reemplazamos solo las filas de la ciudad
+        if inspect(engine).has_table(TABLE, schema=SCHEMA):
+            with engine.begin() as conn:
+                conn.execute(text(f"DELETE FROM {SCHEMA}.{TABLE} WHERE city = :city"), {"city": city})
+        df_out.to_sql(TABLE, engine, schema=SCHEMA, if_exists='append', index=False, chunksize=5000)
+        print(f"   ✅ {len(df_out)} hexágonos en {time.time() - t0:.1f}s.")
+
+    if not inspect(engine).has_table(TABLE, schema=SCHEMA):
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_grid_dist_h3 ON {SCHEMA}.{TABLE} (h3_id);"))
+
+if __name__ == "__main__":
+    # Uso: python core_data_processing/06_grid_distance_features.py [CIUDAD ...]
+    targets = sys.argv[1:] or ACTIVE_CITIES or list(CITY_BBOXES.keys())
+    main(targets)
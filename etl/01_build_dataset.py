@@ -1,14 +1,14 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import h3
 import requests
-from shapely.geometry import Polygon, Point, box
+from shapely.geometry import Point
 from sqlalchemy import create_engine
-from rasterstats import zonal_stats
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import warnings
 import sys
 import os
-import math
 
 # ==========================================
 # 1. SETUP Y CONFIGURACIÓN
@@ -30,16 +30,19 @@ except ImportError:
     print("❌ Error: No encuentro 'config.py'.")
     sys.exit(1)
 
+from conf import OSRM_MAX_TABLE_SIZE, OSRM_MAX_IN_FLIGHT, GRAPH_DIR, OSRM_DATA_DIR, HINT_CACHE_PATH, MAX_SNAP_M
+from services.osrm_client import OSRMClient, CircuitBreaker
+from services.osrm_hints import HintCache, point_key
+from services.h3_grid import city_grid
+from services.h3_raster import aggregate_raster
+from services.street_graph import graph_nearest_times, WALK_SPEED_MS
+
 warnings.filterwarnings("ignore")
 
 CSV_PATH = os.path.join(project_root, "data", "processed", "final_dataset.csv")
 GHS_FILENAME = "GHS_BUILT_S_E1975_GLOBE_R2023A_4326_3ss_V1_0.tif"
 GHS_PATH = os.path.join(project_root, DATA_DIR, GHS_FILENAME)
 
-print(f"🔧 Configuración cargada.")
-print(f"📡 OSRM URL: {OSRM_WALK_URL} (Prioridad Máxima)")
-print(f"🛢️ Transporte: Usando PostGIS Local")
-
 # ==========================================
 # 2. FUNCIONES DE CARGA
 # ==========================================
@@ -62,28 +65,15 @@ def get_transport_from_db(bbox_dict):
 def filter_by_urban_footprint(df_hex):
     if not os.path.exists(GHS_PATH): return df_hex
     
-    hex_polygons = []
-    for h in df_hex['h3_index']:
-        geo_json = h3.h3_to_geo_boundary(h, geo_json=True)
-        hex_polygons.append(Polygon(geo_json))
-    
-    gdf_temp = gpd.GeoDataFrame({'h3_index': df_hex['h3_index']}, geometry=hex_polygons, crs="EPSG:4326")
-    stats = zonal_stats(vectors=gdf_temp['geometry'], raster=GHS_PATH, stats=['sum'])
-    df_hex['built_up_score'] = [x['sum'] if x['sum'] is not None else 0 for x in stats]
+    df_hex['built_up_score'] = aggregate_raster(GHS_PATH, df_hex['h3_index'], 'sum').values
     
     return df_hex[df_hex['built_up_score'] > 50].copy()
 
 def get_hexagons_from_bbox(city_name, bbox_dict):
-    bbox_poly = box(bbox_dict['min_lon'], bbox_dict['min_lat'], bbox_dict['max_lon'], bbox_dict['max_lat'])
     try:
-        hexs = h3.polyfill(bbox_poly.__geo_interface__, H3_RESOLUTION, geo_json_conformant=True)
+        grid = city_grid(city_name, bbox_dict, H3_RESOLUTION)
     except: return pd.DataFrame()
-    
-    df_hex = pd.DataFrame(list(hexs), columns=['h3_index'])
-    df_hex['city'] = city_name
-    df_hex['lat'] = df_hex['h3_index'].apply(lambda x: h3.h3_to_geo(x)[0])
-    df_hex['lon'] = df_hex['h3_index'].apply(lambda x: h3.h3_to_geo(x)[1])
-    return df_hex
+    return grid.frame("h3_index", city=city_name)
 
 def get_google_pois_from_db(city_name):
     print(f"      🛢️ Consultando PostGIS (POIs Comerciales)...")
@@ -118,118 +108,298 @@ def get_google_pois_from_db(city_name):
 # 3. LÓGICA DE CÁLCULO INTELIGENTE (PRIORIDAD OSRM)
 # ==========================================
 
-def calculate_distance_smart(row, dest_gdf):
+# Proyección plana local (metros): la misma que usaba el rescate euclidiano
+M_PER_DEG_LAT = 111132
+M_PER_DEG_LON = 85000
+MAX_DIST_M = 5000
+
+# 'graph': Dijkstra multi-origen sobre el grafo peatonal local (GRAPH_DIR/<CIUDAD>_foot):
+#   todos los POIs de la categoría son fuentes y un recorrido da el tiempo de cada nodo al
+#   más cercano. Una categoría por proceso. Si la ciudad no tiene grafo compilado -> 'table'.
+# 'table': k candidatos por hexágono resueltos con /table por lotes (muchos orígenes contra
+# destinos deduplicados) y nos quedamos con el de menor tiempo andando.
+# 'route': clásico, una petición /route al más cercano en línea recta por fila.
+ROUTING_MODE = "table"
+K_CANDIDATES = 5
+
+# Cliente OSRM, cortocircuito y caché de hints: se crean en main(). Los procesos del modo
+# 'graph' importan este módulo y no deben abrir conexiones ni la caché al arrancar.
+osrm_client = None
+osrm_breaker = None
+hint_cache = None
+
+def setup_routing():
+    global osrm_client, osrm_breaker, hint_cache
+    # Si OSRM falla varias veces seguidas, el resto va directo a euclidiano sin esperar timeouts
+    osrm_client = OSRMClient(OSRM_WALK_URL, profile="foot", max_in_flight=OSRM_MAX_IN_FLIGHT, retries=1, timeout=5)
+    osrm_breaker = CircuitBreaker(failures=3, cooldown=30)
+    # Hints de /nearest: centroides y POIs se snapean una vez y se reutilizan entre ejecuciones
+    hint_cache = HintCache(os.path.join(project_root, HINT_CACHE_PATH), os.path.join(project_root, OSRM_DATA_DIR))
+
+def project_m(lons, lats):
+    return np.column_stack([np.asarray(lons, dtype=float) * M_PER_DEG_LON,
+                            np.asarray(lats, dtype=float) * M_PER_DEG_LAT])
+
+def nearest_facilities(df_hex, dest_gdf, k=1):
     """
-    1. Intenta OSRM SIEMPRE.
-    2. Si falla OSRM, usa Euclidian.
+    Un cKDTree por categoría y una sola consulta para todos los hexágonos.
+    Devuelve (posición en dest_gdf, distancia en metros) de los k POIs más cercanos:
+    arrays (n,) con k=1, (n, k) si k > 1 (ordenados de más cerca a más lejos).
     """
-    # 0. ¿VACÍO?
-    if dest_gdf is None or dest_gdf.empty: 
-        return 5000, 'MAX'
+    tree = cKDTree(project_m(dest_gdf.geometry.x, dest_gdf.geometry.y))
+    dist_m, idx = tree.query(project_m(df_hex['lon'], df_hex['lat']), k=min(k, len(dest_gdf)))
+    if k > 1 and idx.ndim == 1:
+        idx, dist_m = idx[:, None], dist_m[:, None]
+    return idx, dist_m
 
-    origin_lat, origin_lon = row['lat'], row['lon']
-    origin_point = Point(origin_lon, origin_lat)
-    
-    # Buscamos el POI más cercano (necesario para saber a dónde rutear)
-    series_dist = dest_gdf.distance(origin_point)
-    nearest_idx = series_dist.idxmin()
-    nearest_dist_deg = series_dist.loc[nearest_idx]
-    nearest_poi = dest_gdf.loc[nearest_idx]
-
-    # 1. FILTRO DE LEJANÍA OBVIA (> 5km)
-    if nearest_dist_deg > 0.05: 
-        return 5000, 'MAX'
+def euclidean_seconds(dist_m):
+    # Penalización x1.35 sobre la línea recta, a 1.25 m/s
+    return (np.asarray(dist_m) * 1.35) / 1.25
 
-    # 2. INTENTO OSRM (PRIORIDAD TOTAL)
-    # No importa si está dentro o fuera, lo intentamos.
-    url = f"{OSRM_WALK_URL}/route/v1/foot/{origin_lon},{origin_lat};{nearest_poi.geometry.x},{nearest_poi.geometry.y}?overview=false"
+def osrm_route_seconds(origin_lon, origin_lat, dest_lon, dest_lat, hints=None):
+    url = f"{OSRM_WALK_URL}/route/v1/foot/{origin_lon},{origin_lat};{dest_lon},{dest_lat}?overview=false"
+    if hints and any(hints):
+        url += f"&hints={';'.join(hints)}"
     try:
         r = requests.get(url, timeout=0.15) 
         if r.status_code == 200:
             res = r.json()
             if 'routes' in res and len(res['routes']) > 0:
-                duration = res['routes'][0]['duration']
-                return duration, 'OSRM'
+                return res['routes'][0]['duration']
     except:
         pass # Fallo técnico o de snapping -> Pasamos a Plan B
+    return None
 
-    # 3. RESCATE EUCLIDIANO (Solo si OSRM falla)
-    dy_meters = (nearest_poi.geometry.y - origin_lat) * 111132
-    dx_meters = (nearest_poi.geometry.x - origin_lon) * 85000
-    dist_meters = math.sqrt(dx_meters**2 + dy_meters**2)
-    
-    # Penalización x1.35
-    walking_seconds = (dist_meters * 1.35) / 1.25
-    
-    return walking_seconds, 'EUCLID'
+def snap_hints(df_hex, dest_gdf):
+    """
+    Hints y distancia de snapping (m) de los hexágonos (clave h3:<h3_index>) y de los POIs
+    (clave por su celda res 12). NaN de snapping donde /nearest no respondió.
+    """
+    hex_items = [(f"h3:{h}", lon, lat) for h, lon, lat in zip(df_hex['h3_index'], df_hex['lon'], df_hex['lat'])]
+    poi_items = [(point_key(lat, lon), lon, lat) for lon, lat in zip(dest_gdf.geometry.x, dest_gdf.geometry.y)]
+    hex_found = hint_cache.lookup(osrm_client, hex_items, breaker=osrm_breaker)
+    poi_found = hint_cache.lookup(osrm_client, poi_items, breaker=osrm_breaker)
+    hex_hints = np.array([h for h, _ in hex_found], dtype=object)
+    hex_snap = np.array([np.nan if d is None else d for _, d in hex_found], dtype=float)
+    poi_hints = np.array([h for h, _ in poi_found], dtype=object)
+    return hex_hints, hex_snap, poi_hints
+
+def table_batches(rows, candidates, max_cells):
+    """
+    Agrupa filas (ya ordenadas por cercanía) mientras orígenes x destinos únicos
+    quepa en una llamada /table (max_table_size^2).
+    """
+    batch, dests = [], set()
+    for i in rows:
+        merged = dests | set(candidates[i])
+        if batch and (len(batch) + 1) * len(merged) > max_cells:
+            yield np.array(batch), np.array(sorted(dests))
+            batch, merged = [], set(candidates[i])
+        batch.append(i)
+        dests = merged
+    if batch:
+        yield np.array(batch), np.array(sorted(dests))
+
+def osrm_table_min_seconds(df_hex, dest_gdf, rows, candidates, hex_hints, poi_hints):
+    """
+    Mínimo tiempo andando de cada fila a sus k candidatos, por lotes /table en paralelo.
+    NaN donde no hay ruta o el lote no se pudo calcular (OSRM caído o cortocircuito abierto).
+    """
+    lons, lats = df_hex['lon'].values, df_hex['lat'].values
+    dest_lon, dest_lat = dest_gdf.geometry.x.values, dest_gdf.geometry.y.values
+    best = np.full(len(df_hex), np.nan)
+
+    def run(batch):
+        rows_b, dests = batch
+        if not osrm_breaker.allow():
+            return rows_b, None
+        coords = ([f"{lons[i]},{lats[i]}" for i in rows_b] +
+                  [f"{dest_lon[j]},{dest_lat[j]}" for j in dests])
+        hints = list(hex_hints[rows_b]) + list(poi_hints[dests])
+        try:
+            durations = osrm_client.table(coords, sources=range(len(rows_b)), destinations=range(len(rows_b), len(coords)),
+                                          hints=hints)
+        except Exception:
+            osrm_breaker.record_failure()
+            return rows_b, None
+        osrm_breaker.record_success()
+        matrix = np.array(durations, dtype=float).reshape(len(rows_b), len(dests))  # None -> NaN
+        cols = np.searchsorted(dests, candidates[rows_b])
+        times = matrix[np.arange(len(rows_b))[:, None], cols]
+        # El candidato ganador es el de menor tiempo andando, no el más cercano en línea recta
+        times = np.where(np.isnan(times), np.inf, times).min(axis=1)
+        return rows_b, np.where(np.isinf(times), np.nan, times)
+
+    batches = list(table_batches(rows, candidates, OSRM_MAX_TABLE_SIZE ** 2))
+    with ThreadPoolExecutor(max_workers=OSRM_MAX_IN_FLIGHT) as pool:
+        for b, (rows_b, times) in enumerate(pool.map(run, batches), 1):
+            if times is not None:
+                best[rows_b] = times
+            if b % 50 == 0: print(f"         lote {b}/{len(batches)}...", end="\r")
+    return best
+
+def graph_times_by_metric(graph_dir, df_hex, sources_by_metric):
+    """
+    {métrica: segundos andando de cada hexágono (centroide) a su POI más cercano}, con un
+    Dijkstra multi-origen por métrica en paralelo. La búsqueda se corta en el doble de
+    MAX_DIST_M andando (margen para los rodeos); más allá, NaN.
+    """
+    queries = np.column_stack([df_hex['lon'].values, df_hex['lat'].values])
+    limit = 2 * MAX_DIST_M / WALK_SPEED_MS
+    metrics = [m for m, gdf in sources_by_metric.items() if gdf is not None and not gdf.empty]
+    args = [np.column_stack([sources_by_metric[m].geometry.x.values, sources_by_metric[m].geometry.y.values])
+            for m in metrics]
+    with ProcessPoolExecutor(max_workers=len(metrics) or 1) as pool:
+        times = pool.map(graph_nearest_times, [graph_dir] * len(metrics), args,
+                         [queries] * len(metrics), [limit] * len(metrics))
+        return dict(zip(metrics, times))
+
+def calculate_distances_smart(df_hex, dest_gdf, mode=ROUTING_MODE, graph_seconds=None):
+    """
+    1. Intenta la red SIEMPRE (mode: 'graph' con graph_seconds ya calculados, /table con
+       k candidatos o /route al más cercano).
+    2. Si falla, usa Euclidian (calculado de golpe para todas las filas).
+    Devuelve (segundos, fuente) alineados con df_hex.
+    """
+    n = len(df_hex)
+    # 0. ¿VACÍO?
+    if dest_gdf is None or dest_gdf.empty:
+        return np.full(n, 5000.0), np.full(n, 'MAX', dtype=object)
+
+    candidates, cand_dist = nearest_facilities(df_hex, dest_gdf, k=K_CANDIDATES if mode == "table" else 1)
+    idx, dist_m = (candidates[:, 0], cand_dist[:, 0]) if candidates.ndim == 2 else (candidates, cand_dist)
+
+    # 3. RESCATE EUCLIDIANO (por defecto; OSRM lo sustituye donde responde)
+    values = euclidean_seconds(dist_m)
+    sources = np.full(n, 'EUCLID', dtype=object)
+
+    # 1. FILTRO DE LEJANÍA OBVIA (> 5km)
+    far = dist_m > MAX_DIST_M
+    values[far] = 5000
+    sources[far] = 'MAX'
+
+    # 2. INTENTO RED (PRIORIDAD TOTAL)
+    if mode == "graph":
+        ok = ~far & ~np.isnan(graph_seconds)
+        values[ok] = graph_seconds[ok]
+        sources[ok] = 'GRAPH'
+        return values, sources
+
+    # Centroides que snapean lejos de la red (parques, agua...): se marcan y no se rutan
+    hex_hints, hex_snap, poi_hints = snap_hints(df_hex, dest_gdf)
+    snap_far = ~far & (hex_snap > MAX_SNAP_M)
+    sources[snap_far] = 'SNAP_FAR'
+    routable = ~far & ~snap_far
+
+    if mode == "table":
+        # Orden por índice H3: filas vecinas comparten candidatos y los lotes salen más densos
+        rows = np.flatnonzero(routable)
+        rows = rows[np.argsort(df_hex['h3_index'].values[rows], kind="stable")]
+        best = osrm_table_min_seconds(df_hex, dest_gdf, rows, candidates, hex_hints, poi_hints)
+        ok = ~np.isnan(best)
+        values[ok] = best[ok]
+        sources[ok] = 'OSRM'
+        return values, sources
+
+    dest_lon = dest_gdf.geometry.x.values[idx]
+    dest_lat = dest_gdf.geometry.y.values[idx]
+    lons, lats = df_hex['lon'].values, df_hex['lat'].values
+    for i in np.flatnonzero(routable):
+        if i % 500 == 0: print(f"         {i}/{n}...", end="\r")
+        if not osrm_breaker.allow():
+            continue
+        duration = osrm_route_seconds(lons[i], lats[i], dest_lon[i], dest_lat[i], (hex_hints[i], poi_hints[idx[i]]))
+        if duration is not None:
+            osrm_breaker.record_success()
+            values[i] = duration
+            sources[i] = 'OSRM'
+        else:
+            osrm_breaker.record_failure()
+
+    return values, sources
 
 # ==========================================
 # 4. PROCESO PRINCIPAL
 # ==========================================
 
-print(f"🚀 GENERANDO DATASET (PRIORIDAD OSRM + FALLBACK)...")
-os.makedirs(os.path.dirname(CSV_PATH), exist_ok=True)
+def main():
+    print(f"🔧 Configuración cargada.")
+    print(f"📡 OSRM URL: {OSRM_WALK_URL} (Prioridad Máxima)")
+    print(f"🛢️ Transporte: Usando PostGIS Local")
+    setup_routing()
 
-if ACTIVE_CITIES:
-    cities_to_process = [c for c in ACTIVE_CITIES if c in CITY_BBOXES]
-else:
-    cities_to_process = list(CITY_BBOXES.keys())
+    print(f"🚀 GENERANDO DATASET (PRIORIDAD OSRM + FALLBACK)...")
+    os.makedirs(os.path.dirname(CSV_PATH), exist_ok=True)
+
+    if ACTIVE_CITIES:
+        cities_to_process = [c for c in ACTIVE_CITIES if c in CITY_BBOXES]
+    else:
+        cities_to_process = list(CITY_BBOXES.keys())
 
-for city_name in cities_to_process:
-    print(f"\n🏙️  {city_name}")
-    bbox = CITY_BBOXES[city_name]
+    for city_name in cities_to_process:
+        print(f"\n🏙️  {city_name}")
+        bbox = CITY_BBOXES[city_name]
     
-    # A. Hexágonos
-    df_hex = get_hexagons_from_bbox(city_name, bbox)
-    if df_hex.empty: continue
-    print(f"      ⬡ Brutos: {len(df_hex)}")
-
-    # B. Filtro GHS
-    df_hex = filter_by_urban_footprint(df_hex)
-    if df_hex.empty: continue
-
-    # C. Transporte
-    print("      🚌 Consultando transporte...")
-    gdf_transit = get_transport_from_db(bbox)
+        # A. Hexágonos
+        df_hex = get_hexagons_from_bbox(city_name, bbox)
+        if df_hex.empty: continue
+        print(f"      ⬡ Brutos: {len(df_hex)}")
+
+        # B. Filtro GHS
+        df_hex = filter_by_urban_footprint(df_hex)
+        if df_hex.empty: continue
+
+        # C. Transporte
+        print("      🚌 Consultando transporte...")
+        gdf_transit = get_transport_from_db(bbox)
     
-    # D. POIs
-    google_pois = get_google_pois_from_db(city_name)
+        # D. POIs
+        google_pois = get_google_pois_from_db(city_name)
     
-    # E. Inicialización de columnas
-    metrics = ['cafe', 'gym', 'shop', 'transit']
-    for m in metrics:
-        df_hex[f'dist_{m}'] = 5000.0
-        df_hex[f'source_{m}'] = 'INIT' 
-
-    total = len(df_hex)
-    print(f"      🚀 Calculando tiempos (OSRM mandatorio)...")
-
-    # F. Bucle de Cálculo
-    for idx, row in df_hex.iterrows():
-        if idx % 500 == 0: print(f"         {idx}/{total}...", end="\r")
-        
-        # Iteramos por métrica
-        for metric, gdf_source in [
-            ('cafe', google_pois.get('cafe')),
-            ('gym', google_pois.get('gym')),
-            ('shop', google_pois.get('shop')),
-            ('transit', gdf_transit)
-        ]:
+        # E. Inicialización de columnas
+        metrics = ['cafe', 'gym', 'shop', 'transit']
+        for m in metrics:
+            df_hex[f'dist_{m}'] = 5000.0
+            df_hex[f'source_{m}'] = 'INIT' 
+
+        sources_by_metric = {
+            'cafe': google_pois.get('cafe'),
+            'gym': google_pois.get('gym'),
+            'shop': google_pois.get('shop'),
+            'transit': gdf_transit
+        }
+
+        mode = ROUTING_MODE
+        graph_times = {}
+        graph_dir = os.path.join(project_root, GRAPH_DIR, f"{city_name}_foot")
+        if mode == "graph" and not os.path.exists(os.path.join(graph_dir, "indptr.npy")):
+            print(f"      ⚠️ Sin grafo peatonal en {graph_dir} (etl/osm_Data/01_build_street_graph.py). Usando OSRM /table.")
+            mode = "table"
+        if mode == "graph":
+            print(f"      🕸️ Calculando tiempos (Dijkstra multi-origen, una categoría por proceso)...")
+            graph_times = graph_times_by_metric(graph_dir, df_hex, sources_by_metric)
+        else:
+            print(f"      🚀 Calculando tiempos (OSRM mandatorio)...")
+
+        # F. Cálculo por métrica (todas las filas a la vez)
+        for metric, gdf_source in sources_by_metric.items():
             if gdf_source is not None and not gdf_source.empty:
-                # Ya no pasamos mapas de presencia, solo la fila y el destino
-                val, src = calculate_distance_smart(row, gdf_source)
-                
-                df_hex.at[idx, f'dist_{metric}'] = val
-                df_hex.at[idx, f'source_{metric}'] = src
-
-    # G. Guardado
-    if os.path.exists(CSV_PATH):
-        df_old = pd.read_csv(CSV_PATH)
-        df_final = pd.concat([df_old[df_old['city'] != city_name], df_hex], ignore_index=True)
-    else:
-        df_final = df_hex
+                print(f"      📍 {metric}: {len(gdf_source)} destinos")
+                val, src = calculate_distances_smart(df_hex, gdf_source, mode, graph_times.get(metric))
+                df_hex[f'dist_{metric}'] = val
+                df_hex[f'source_{metric}'] = src
+
+        # G. Guardado
+        if os.path.exists(CSV_PATH):
+            df_old = pd.read_csv(CSV_PATH)
+            df_final = pd.concat([df_old[df_old['city'] != city_name], df_hex], ignore_index=True)
+        else:
+            df_final = df_hex
+
+        df_final.to_csv(CSV_PATH, index=False)
+        print(f"\n      ✅ Guardado datos de {city_name}.")
 
-    df_final.to_csv(CSV_PATH, index=False)
-    print(f"\n      ✅ Guardado datos de {city_name}.")
+    print("\n🏁 PROCESO TERMINADO.")
 
-print("\n🏁 PROCESO TERMINADO.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import sys
+import os
+import glob
+import time
+
+# ================= SETUP DE RUTAS =================
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(project_root)
+
+try:
+    from conf import CITY_BBOXES, ACTIVE_CITIES, DATA_DIR, GRAPH_DIR
+except ImportError:
+    sys.exit("❌ Error: No encuentro conf.py")
+
+from services.street_graph import build_street_graph
+
+def latest_pbf():
+    """El extracto de España más reciente en data/raw (spain-YYMMDD.osm.pbf)."""
+    pbfs = sorted(glob.glob(os.path.join(project_root, DATA_DIR, "spain-*.osm.pbf")))
+    return pbfs[-1] if pbfs else None
+
+def main(cities):
+    pbf_path = latest_pbf()
+    if not pbf_path:
+        sys.exit(f"❌ No hay ningún spain-*.osm.pbf en {DATA_DIR}")
+
+    for city in cities:
+        if city not in CITY_BBOXES:
+            print(f"⚠️ {city} no está en CITY_BBOXES. Saltando.")
+            continue
+
+        print(f"\n🏙️  Compilando grafo peatonal de {city}...")
+        t0 = time.time()
+        out_dir = os.path.join(project_root, GRAPH_DIR, f"{city}_foot")
+        build_street_graph(pbf_path, CITY_BBOXES[city], out_dir)
+        print(f"   ⏱️ {time.time() - t0:.0f}s")
+
+if __name__ == "__main__":
+    # Uso: python etl/osm_Data/01_build_street_graph.py [CIUDAD ...]
+    targets = sys.argv[1:] or ACTIVE_CITIES or list(CITY_BBOXES.keys())
+    main(targets)
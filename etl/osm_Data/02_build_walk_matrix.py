@@ -0,0 +1,42 @@
+import sys
+import os
+import time
+import pandas as pd
+from sqlalchemy import create_engine
+
+# ================= SETUP DE RUTAS =================
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(project_root)
+
+try:
+    from conf import (
+        DB_URL, CITY_BBOXES, ACTIVE_CITIES, OSRM_WALK_URL, OSRM_MAX_TABLE_SIZE,
+        OSRM_MAX_IN_FLIGHT, WALK_MATRIX_DIR, WALK_MATRIX_RADIUS_M
+    )
+except ImportError:
+    sys.exit("❌ Error: No encuentro conf.py")
+
+from services.osrm_client import OSRMClient
+from services.walk_matrix import build_walk_matrix
+
+def main(cities, radius_m=WALK_MATRIX_RADIUS_M):
+    engine = create_engine(DB_URL)
+    osrm = OSRMClient(OSRM_WALK_URL, profile="foot", max_in_flight=OSRM_MAX_IN_FLIGHT)
+
+    for city in cities:
+        df = pd.read_sql(f"SELECT h3_id FROM core.hexagons WHERE city = '{city}'", engine)
+        if df.empty:
+            print(f"⚠️ {city} no tiene hexágonos en core.hexagons. Saltando.")
+            continue
+
+        print(f"\n🏙️  Matriz de tiempos andando de {city}...")
+        t0 = time.time()
+        out_dir = os.path.join(project_root, WALK_MATRIX_DIR, city)
+        build_walk_matrix(df['h3_id'].tolist(), osrm, out_dir, radius_m=radius_m, max_table_size=OSRM_MAX_TABLE_SIZE)
+        print(f"   ⏱️ {time.time() - t0:.0f}s")
+
+if __name__ == "__main__":
+    # Uso: python etl/osm_Data/02_build_walk_matrix.py [CIUDAD ...]
+    targets = sys.argv[1:] or ACTIVE_CITIES or list(CITY_BBOXES.keys())
+    main(targets)
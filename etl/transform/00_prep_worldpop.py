@@ -1,7 +1,23 @@
 import rasterio
 import numpy as np
 import os
+import sys
 import glob
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window, from_bounds
+from rasterio.shutil import copy as rio_copy
+
+# ================= SETUP DE RUTAS =================
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(project_root)
+
+try:
+    from conf import CITY_BBOXES
+except ImportError:
+    sys.exit("❌ Error: No encuentro conf.py")
 
 # --- CONFIGURACIÓN ---
 # Carpeta donde YA tienes los ficheros .tif descargados
@@ -9,13 +25,62 @@ INPUT_DIR = "data/raw/worldpop_parts"
 # Archivo final que generaremos
 OUTPUT_TIF = "data/raw/target_audience_combined.tif"
 
+# Margen (grados) alrededor de cada ciudad: el raster de salida solo cubre las ciudades
+CLIP_MARGIN_DEG = 0.05
+# Tamaño mínimo (píxeles) de los bloques que se suman; se alinea con el tiling del origen
+BLOCK = 512
+WORKERS = min(8, os.cpu_count() or 1)
+NODATA = -99999.0
+
+def city_windows(src):
+    """Ventanas (en la rejilla de origen) de cada ciudad + margen, recortadas al raster."""
+    windows = []
+    for bbox in CITY_BBOXES.values():
+        w = from_bounds(bbox['min_lon'] - CLIP_MARGIN_DEG, bbox['min_lat'] - CLIP_MARGIN_DEG,
+                        bbox['max_lon'] + CLIP_MARGIN_DEG, bbox['max_lat'] + CLIP_MARGIN_DEG, src.transform)
+        row0, col0 = max(0, math.floor(w.row_off)), max(0, math.floor(w.col_off))
+        row1 = min(src.height, math.ceil(w.row_off + w.height))
+        col1 = min(src.width, math.ceil(w.col_off + w.width))
+        if row1 > row0 and col1 > col0:
+            windows.append(Window(col0, row0, col1 - col0, row1 - row0))
+    return windows
+
+def _union(windows):
+    row0 = min(int(w.row_off) for w in windows)
+    col0 = min(int(w.col_off) for w in windows)
+    row1 = max(int(w.row_off + w.height) for w in windows)
+    col1 = max(int(w.col_off + w.width) for w in windows)
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+def _blocks(windows, block_h, block_w, height, width):
+    """
+    Bloques (ventanas de origen, múltiplos de los bloques del fichero y de al menos BLOCK px;
+    de BLOCK px de ancho si el fichero va en tiras) que cubren las ciudades, sin repetir los
+    que comparten ciudades vecinas.
+    """
+    step_h = max(1, math.ceil(BLOCK / block_h)) * block_h
+    if block_w >= width:
+        # Fichero en tiras (WorldPop nacional: bloques de 1 x ancho): por columnas no hay
+        # bloques que respetar, se corta cada BLOCK px para que el recorte siga a las ciudades
+        step_w = BLOCK
+    else:
+        step_w = max(1, math.ceil(BLOCK / block_w)) * block_w
+    seen = set()
+    for w in windows:
+        for r in range((int(w.row_off) // step_h) * step_h, int(w.row_off + w.height), step_h):
+            for c in range((int(w.col_off) // step_w) * step_w, int(w.col_off + w.width), step_w):
+                if (r, c) in seen:
+                    continue
+                seen.add((r, c))
+                yield Window(c, r, min(step_w, width - c), min(step_h, height - r))
+
 def combine_rasters():
     print(f"🧪 COCINANDO DATOS DEMOGRÁFICOS DESDE: {INPUT_DIR}")
-    
+
     # 1. BUSCAR ARCHIVOS
     # Buscamos cualquier cosa que termine en .tif dentro de la carpeta
-    tif_files = glob.glob(os.path.join(INPUT_DIR, "*.tif"))
-    
+    tif_files = sorted(glob.glob(os.path.join(INPUT_DIR, "*.tif")))
+
     if not tif_files:
         print(f"❌ ERROR: No hay archivos .tif en {INPUT_DIR}")
         print("   Por favor, mete ahí los archivos de las franjas de edad (15-19, 20-24, etc).")
@@ -23,58 +88,74 @@ def combine_rasters():
 
     print(f"   -> Encontrados {len(tif_files)} archivos para sumar.")
 
-    # 2. INICIALIZAR ACUMULADOR
-    # Necesitamos leer el primero para saber el tamaño del mapa (ancho x alto) y la georreferencia
-    first_file = tif_files[0]
-    meta = None
-    total_array = None
-
-    with rasterio.open(first_file) as src:
-        meta = src.profile.copy()
-        # Leemos el primer array para inicializar la suma
-        # Reemplazamos los valores negativos (NoData de WorldPop suele ser -99999) por 0
-        first_data = src.read(1)
-        first_data[first_data < 0] = 0 
-        total_array = first_data.astype(np.float32)
-
-    print(f"   🔹 Base establecida con: {os.path.basename(first_file)}")
-
-    # 3. SUMAR EL RESTO
-    # Iteramos desde el segundo archivo hasta el final
-    for filepath in tif_files[1:]:
-        filename = os.path.basename(filepath)
-        print(f"   ➕ Sumando: {filename}...")
-        
-        try:
-            with rasterio.open(filepath) as src:
-                # Verificación de seguridad: ¿Tienen el mismo tamaño?
-                if src.width != meta['width'] or src.height != meta['height']:
-                    print(f"      ⚠️ AVISO: {filename} tiene dimensiones distintas. Saltando...")
-                    continue
-                
-                # Leer datos
-                data = src.read(1)
-                
-                # Limpieza de NoData (Valores negativos a 0)
-                data[data < 0] = 0
-                
-                # Suma matricial
-                total_array += data
-                
-        except Exception as e:
-            print(f"      ❌ Error leyendo {filename}: {e}")
-
-    # 4. GUARDAR RESULTADO
-    print(f"💾 Guardando Raster Combinado en: {OUTPUT_TIF}")
-    
-    # Actualizamos los metadatos para asegurar que guardamos floats
-    meta.update(dtype=rasterio.float32, count=1, compress='lzw')
-
-    with rasterio.open(OUTPUT_TIF, 'w', **meta) as dst:
-        dst.write(total_array, 1)
+    # 2. REJILLA DE REFERENCIA Y RECORTE
+    # El primer fichero marca la rejilla; solo se leen los bloques que tocan alguna ciudad
+    with rasterio.open(tif_files[0]) as src:
+        profile = src.profile.copy()
+        grid = (src.transform, src.width, src.height)
+        block_h, block_w = src.block_shapes[0]
+        windows = city_windows(src)
+
+    if not windows:
+        print("❌ ERROR: Ninguna ciudad de CITY_BBOXES cae dentro de los rasters.")
+        return
+
+    bands = []
+    for filepath in tif_files:
+        with rasterio.open(filepath) as src:
+            # Verificación de seguridad: ¿Tienen la misma rejilla?
+            if (src.transform, src.width, src.height) != grid:
+                print(f"      ⚠️ AVISO: {os.path.basename(filepath)} tiene una rejilla distinta. Saltando...")
+                continue
+        bands.append(filepath)
+
+    blocks = list(_blocks(windows, block_h, block_w, profile['height'], profile['width']))
+    clip = _union(blocks)
+    print(f"   ✂️ Recorte a las ciudades: {clip.width}x{clip.height} px ({len(blocks)} bloques, {WORKERS} hilos)")
+
+    # 3. SUMAR POR BLOQUES
+    # Cada hilo abre sus propios ficheros (un dataset de rasterio no se comparte entre hilos)
+    local = threading.local()
+    opened = []
+
+    def sum_block(window):
+        if not hasattr(local, "sources"):
+            local.sources = [rasterio.open(f) for f in bands]
+            opened.extend(local.sources)
+        total = np.zeros((int(window.height), int(window.width)), dtype=np.float32)
+        for src in local.sources:
+            data = src.read(1, window=window)
+            # Limpieza de NoData (Valores negativos a 0)
+            total += np.where(data > 0, data, 0).astype(np.float32)
+        return window, total
+
+    tmp_tif = OUTPUT_TIF + ".tmp.tif"
+    meta = profile.copy()
+    meta.update(driver="GTiff", dtype=rasterio.float32, count=1, nodata=NODATA,
+                width=int(clip.width), height=int(clip.height),
+                transform=rasterio.windows.transform(clip, profile['transform']),
+                tiled=True, blockxsize=BLOCK, blockysize=BLOCK, compress='deflate', sparse_ok=True)
+
+    with rasterio.open(tmp_tif, 'w', **meta) as dst, ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        # Fuera de las ciudades no se escribe nada: esos bloques quedan como NoData.
+        # Tandas de pocos bloques por hilo para no acumular sumas pendientes de escribir.
+        chunk = WORKERS * 4
+        for start in range(0, len(blocks), chunk):
+            for window, total in pool.map(sum_block, blocks[start:start + chunk]):
+                out = Window(window.col_off - clip.col_off, window.row_off - clip.row_off, window.width, window.height)
+                dst.write(total, 1, window=out)
+            print(f"      {min(start + chunk, len(blocks))}/{len(blocks)} bloques...", end="\r")
+    for src in opened:
+        src.close()
+
+    # 4. GUARDAR RESULTADO COMO COG (teselado + overviews)
+    print(f"💾 Guardando Raster Combinado (COG) en: {OUTPUT_TIF}")
+    rio_copy(tmp_tif, OUTPUT_TIF, driver="COG", compress="deflate", predictor=3,
+             blocksize=BLOCK, overview_resampling="average", num_threads=WORKERS)
+    os.remove(tmp_tif)
 
     print("✅ ¡LISTO! Tu 'target_audience_combined.tif' está preparado.")
     print("   👉 Ahora actualiza el script '04_enrich_population.py' para que apunte a este archivo.")
 
 if __name__ == "__main__":
-    combine_rasters()
\ No newline at end of file
+    combine_rasters()
@@ -1,14 +1,22 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, inspect
 from services.isochrone_service import IsochroneService
-from conf import DB_URL
+from services.isochrone_cache import IsochroneCache
+from conf import DB_URL, OSRM_WALK_URL, OSRM_DATA_DIR, ISOCHRONE_CACHE_PATH
 
 def correr_estudio_cliente(nombre_estudio, locales, mins):
     engine = create_engine(DB_URL)
-    service = IsochroneService(DB_URL)
+    # Con caché: repetir un estudio (mismos locales y minutos) no toca OSRM
+    cache = IsochroneCache(ISOCHRONE_CACHE_PATH, OSRM_DATA_DIR, profile="foot")
+    service = IsochroneService(DB_URL, osrm_url=OSRM_WALK_URL, cache=cache)
     
     print(f"🚀 Iniciando Local Pulse: {nombre_estudio}")
     
-    # El servicio guarda en analytics.catchment_areas temporalmente
+    if inspect(engine).has_table("catchment_areas", schema="analytics"):
+        # Restos de un estudio anterior que falló a medias: no deben acabar en este
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM analytics.catchment_areas;"))
+
+    # El servicio guarda (con COPY) en analytics.catchment_areas temporalmente
     service.calculate_and_save(
         locales, 
         minutes=mins, 
@@ -0,0 +1,194 @@
+import io
+import queue
+import struct
+import threading
+import numpy as np
+import shapely
+
+# Cabecera y cola del formato binario de COPY (PGCOPY, ver docs de PostgreSQL "COPY ... binary")
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\0" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+
+# OIDs de los tipos de elemento para arrays
+ARRAY_ELEMENT_OIDS = {"int4": 23, "int8": 20}
+
+_SCALARS = {
+    "int2": struct.Struct(">h"),
+    "int4": struct.Struct(">i"),
+    "int8": struct.Struct(">q"),
+    "float4": struct.Struct(">f"),
+    "float8": struct.Struct(">d"),
+}
+_TEXT_TYPES = {"text", "varchar", "bpchar", "name"}
+
+def _encode_array(values, elem):
+    fmt = _SCALARS[elem]
+    values = list(values)
+    out = [struct.pack(">iiiii", 1, 0, ARRAY_ELEMENT_OIDS[elem], len(values), 1)]
+    size = struct.pack(">i", fmt.size)
+    for v in values:
+        out.append(size + fmt.pack(int(v)))
+    return b"".join(out)
+
+def _encoder(typname):
+    """Función valor -> bytes en el formato binario de recepción del tipo de Postgres."""
+    if typname in _SCALARS:
+        fmt = _SCALARS[typname]
+        cast = float if typname.startswith("float") else int
+        return lambda v: fmt.pack(cast(v))
+    if typname in _TEXT_TYPES:
+        return lambda v: str(v).encode("utf-8")
+    if typname == "bool":
+        return lambda v: b"\x01" if v else b"\x00"
+    if typname.startswith("_") and typname[1:] in ARRAY_ELEMENT_OIDS:
+        return lambda v: _encode_array(v, typname[1:])
+    if typname == "geometry":
+        # PostGIS recibe EWKB en binario; las geometrías ya vienen codificadas por lote
+        return lambda v: v
+    raise ValueError(f"Tipo no soportado en COPY binario: {typname}")
+
+def _ddl_type(value, column):
+    if column == "geometry":
+        return "geometry(Polygon, 4326)"
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return "BIGINT[]"
+    if isinstance(value, (bool, np.bool_)):
+        return "BOOLEAN"
+    if isinstance(value, (int, np.integer)):
+        return "INTEGER"
+    if isinstance(value, (float, np.floating)):
+        return "DOUBLE PRECISION"
+    return "TEXT"
+
+class CopyWriter:
+    """
+    Escritor masivo a Postgres con COPY ... FROM STDIN (FORMAT binary), en un hilo aparte.
+    write(rows) encola lotes de filas (dicts) y vuelve enseguida; si la cola (max_pending
+    lotes) está llena, espera: así el rutado y la escritura se solapan sin acumular memoria.
+    La geometría va como EWKB (SRID 4326). Si la tabla no existe, se crea con el primer lote.
+    rename: {clave de la fila: columna de la tabla}; constants: columnas con valor fijo.
+    Cada lote se confirma (COMMIT) por separado.
+    skip_conflicts: cada lote pasa por una tabla temporal y se inserta con ON CONFLICT DO NOTHING
+    (las filas que ya existen según un índice único de la tabla se descartan).
+    """
+    def __init__(self, engine, table, schema="public", rename=None, constants=None, max_pending=8,
+                 skip_conflicts=False):
+        self.engine = engine
+        self.table = table
+        self.schema = schema
+        self.rename = rename or {}
+        self.constants = constants or {}
+        self.skip_conflicts = skip_conflicts
+        self.rows_written = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._types = None
+        self._thread = threading.Thread(target=self._run, name=f"copy-{schema}.{table}", daemon=True)
+        self._thread.start()
+
+    def write(self, rows):
+        if self._error is not None:
+            raise self._error
+        if rows:
+            self._queue.put(rows)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.rows_written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        conn = None
+        try:
+            conn = self.engine.raw_connection()
+            while True:
+                rows = self._queue.get()
+                if rows is None:
+                    break
+                self.rows_written += self._copy(conn, rows)
+        except Exception as e:
+            self._error = e
+            if conn is not None:
+                conn.rollback()
+            # Vaciamos la cola para no dejar bloqueado a quien está en write()
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _columns(self, conn, sample):
+        """Columnas de la tabla y su tipo (se crea si no existe, a partir de la primera fila)."""
+        cur = conn.cursor()
+        qualified = f"{self.schema}.{self.table}"
+        cur.execute("SELECT to_regclass(%s)", (qualified,))
+        if cur.fetchone()[0] is None:
+            cols = ", ".join(f'"{c}" {_ddl_type(v, c)}' for c, v in sample.items())
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {qualified} ({cols})")
+            conn.commit()
+        cur.execute("""
+            SELECT a.attname, t.typname
+            FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+            WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        """, (qualified,))
+        types = dict(cur.fetchall())
+        cur.close()
+        return types
+
+    def _copy(self, conn, rows):
+        data = {self.rename.get(k, k): [r[k] for r in rows] for k in rows[0]}
+        for c, v in self.constants.items():
+            data[c] = [v] * len(rows)
+        if self._types is None:
+            self._types = self._columns(conn, {c: vals[0] for c, vals in data.items()})
+
+        columns = list(data)
+        missing = [c for c in columns if c not in self._types]
+        if missing:
+            raise ValueError(f"{self.schema}.{self.table} no tiene las columnas {missing}")
+        encoders = [_encoder(self._types[c]) for c in columns]
+
+        # Geometrías a EWKB de una vez para todo el lote
+        for c in columns:
+            if self._types[c] == "geometry":
+                geoms = shapely.set_srid(np.asarray(data[c], dtype=object), 4326)
+                data[c] = shapely.to_wkb(geoms, include_srid=True)
+
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        n_fields = struct.pack(">h", len(columns))
+        null = struct.pack(">i", -1)
+        for values in zip(*(data[c] for c in columns)):
+            buf.write(n_fields)
+            for enc, v in zip(encoders, values):
+                if v is None:
+                    buf.write(null)
+                    continue
+                raw = enc(v)
+                buf.write(struct.pack(">i", len(raw)))
+                buf.write(raw)
+        buf.write(PGCOPY_TRAILER)
+        buf.seek(0)
+
+        cols_sql = ", ".join(f'"{c}"' for c in columns)
+        qualified = f"{self.schema}.{self.table}"
+        cur = conn.cursor()
+        if not self.skip_conflicts:
+            cur.copy_expert(f"COPY {qualified} ({cols_sql}) FROM STDIN (FORMAT binary)", buf)
+            written = len(rows)
+        else:
+            cur.execute(f"CREATE TEMP TABLE copy_stage (LIKE {qualified}) ON COMMIT DROP")
+            cur.copy_expert(f"COPY copy_stage ({cols_sql}) FROM STDIN (FORMAT binary)", buf)
+            cur.execute(f"INSERT INTO {qualified} ({cols_sql}) SELECT {cols_sql} FROM copy_stage ON CONFLICT DO NOTHING")
+            written = cur.rowcount
+        cur.close()
+        conn.commit()
+        return written
@@ -0,0 +1,64 @@
+import math
+import h3
+import numpy as np
+import pandas as pd
+
+def neighbour_graph(h3_ids):
+    """
+    Grafo de vecinos (anillo 1) restringido a la malla dada, como CSR (indptr, indices)
+    sobre las posiciones de h3_ids. Los huecos de la malla (celdas filtradas) cortan caminos.
+    """
+    pos = {h: i for i, h in enumerate(h3_ids)}
+    counts = np.zeros(len(h3_ids), dtype=np.int32)
+    neighbours = []
+    for i, h in enumerate(h3_ids):
+        nb = [pos[n] for n in h3.k_ring(h, 1) if n != h and n in pos]
+        counts[i] = len(nb)
+        neighbours.extend(nb)
+    indptr = np.zeros(len(h3_ids) + 1, dtype=np.int32)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, np.asarray(neighbours, dtype=np.int32)
+
+def multi_source_bfs(indptr, indices, seeds):
+    """
+    Distancia en saltos desde la semilla más cercana para cada celda: un BFS por frentes,
+    todas las semillas a la vez (O(N) por categoría). -1 si no se alcanza ninguna semilla.
+    """
+    hops = np.full(len(indptr) - 1, -1, dtype=np.int32)
+    frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+    hops[frontier] = 0
+    level = 0
+    while len(frontier):
+        level += 1
+        # Vecinos de todo el frente de una vez (gather sobre el CSR)
+        starts, ends = indptr[frontier], indptr[frontier + 1]
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        nb = indices[np.arange(lengths.sum()) + offsets]
+        frontier = np.unique(nb[hops[nb] < 0])
+        hops[frontier] = level
+    return hops
+
+def distance_fields(h3_ids, seeds_by_category, res=None):
+    """
+    h3_ids: malla de la ciudad. seeds_by_category: {'cafe': [h3_id, ...], ...} (celdas con POI).
+    Devuelve un DataFrame indexado por h3_id con hops_<cat> y dist_<cat>_m (saltos x distancia
+    entre centroides vecinos; aproximación por arriba de hasta ~15% frente a la línea recta).
+    """
+    h3_ids = list(h3_ids)
+    res = res if res is not None else h3.h3_get_resolution(h3_ids[0])
+    spacing_m = h3.edge_length(res, 'm') * math.sqrt(3)
+    indptr, indices = neighbour_graph(h3_ids)
+    pos = {h: i for i, h in enumerate(h3_ids)}
+
+    out = pd.DataFrame(index=pd.Index(h3_ids, name='h3_id'))
+    for cat, seeds in seeds_by_category.items():
+        seed_idx = [pos[s] for s in set(seeds) if s in pos]
+        if not seed_idx:
+            out[f'hops_{cat}'] = -1
+            out[f'dist_{cat}_m'] = np.nan
+            continue
+        hops = multi_source_bfs(indptr, indices, seed_idx)
+        out[f'hops_{cat}'] = hops
+        out[f'dist_{cat}_m'] = np.where(hops >= 0, hops * spacing_m, np.nan)
+    return out
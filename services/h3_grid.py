@@ -0,0 +1,100 @@
+import warnings
+import h3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box, mapping
+
+with warnings.catch_warnings():
+    # h3.unstable avisa de que es experimental; solo usamos geo_to_h3 vectorizado
+    warnings.simplefilter("ignore")
+    from h3.unstable import vect as h3_vect
+
+# Vértices por celda: hasta 10 (celdas que cruzan una arista del icosaedro) + cierre. Los anillos
+# más cortos repiten su último vértice para que todas las filas tengan la misma longitud y
+# shapely.polygons los cree de una vez.
+RING_SIZE = 11
+
+def cell_centroids(h3_ids):
+    """(lat, lon) de cada celda como arrays float64."""
+    latlon = np.array([h3.h3_to_geo(h) for h in h3_ids], dtype=np.float64).reshape(-1, 2)
+    return latlon[:, 0].copy(), latlon[:, 1].copy()
+
+def cell_boundaries(h3_ids):
+    """Array (n, 11, 2) con el anillo cerrado (lon, lat) de cada celda."""
+    rings = np.empty((len(h3_ids), RING_SIZE, 2), dtype=np.float64)
+    for i, h in enumerate(h3_ids):
+        ring = h3.h3_to_geo_boundary(h, geo_json=True)
+        rings[i, :len(ring)] = ring
+        rings[i, len(ring):] = ring[-1]
+    return rings
+
+def cell_polygons(h3_ids):
+    """
+    Polígonos shapely (array de objetos) en el orden de h3_ids, en una sola llamada a
+    shapely.polygons. Los ids no válidos (NaN, texto basura) dan None.
+    """
+    h3_ids = list(h3_ids)
+    valid = np.array([isinstance(h, str) and h3.h3_is_valid(h) for h in h3_ids], dtype=bool)
+    out = np.full(len(h3_ids), None, dtype=object)
+    if valid.any():
+        out[valid] = shapely.polygons(cell_boundaries([h for h, ok in zip(h3_ids, valid) if ok]))
+    return out
+
+def points_to_cells(lat, lon, res):
+    """Celda H3 (string) de cada punto, vectorizado."""
+    ints = h3_vect.geo_to_h3(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64), res)
+    return np.array([h3.h3_to_string(int(h)) for h in ints], dtype=object)
+
+def cells_to_parents(h3_ids, res):
+    """Celda padre (string) de cada celda a la resolución res, vectorizado."""
+    ints = np.array([h3.string_to_h3(h) for h in h3_ids], dtype=np.uint64)
+    parents, inverse = np.unique(h3_vect.h3_to_parent(ints, res), return_inverse=True)
+    # Solo se pasan a string los padres distintos (muchos menos que celdas)
+    return np.array([h3.h3_to_string(int(p)) for p in parents], dtype=object)[inverse]
+
+class H3Grid:
+    """
+    Malla H3 como arrays contiguos: ids (ordenados), centroides y anillos de vértices.
+    Los polígonos shapely se construyen la primera vez que se piden.
+    """
+    def __init__(self, h3_ids):
+        self.h3_ids = np.array(sorted(h3_ids), dtype=object)
+        self.lat, self.lon = cell_centroids(self.h3_ids)
+        self.boundaries = cell_boundaries(self.h3_ids)
+        self._polygons = None
+
+    def __len__(self):
+        return len(self.h3_ids)
+
+    @property
+    def polygons(self):
+        if self._polygons is None:
+            self._polygons = shapely.polygons(self.boundaries)
+        return self._polygons
+
+    def frame(self, id_column="h3_id", geometry=False, **constants):
+        """
+        DataFrame nuevo (id, lat, lon + columnas constantes, p. ej. city=...). Con geometry=True
+        es un GeoDataFrame EPSG:4326 con los polígonos. Se puede modificar sin tocar la caché.
+        """
+        df = pd.DataFrame({id_column: self.h3_ids, **constants, "lat": self.lat, "lon": self.lon})
+        if geometry:
+            return gpd.GeoDataFrame(df, geometry=self.polygons, crs="EPSG:4326")
+        return df
+
+def bbox_cells(bbox, res):
+    """Celdas cuyo centroide cae en el bbox ({'min_lat', 'max_lat', 'min_lon', 'max_lon'})."""
+    poly = box(bbox['min_lon'], bbox['min_lat'], bbox['max_lon'], bbox['max_lat'])
+    return h3.polyfill(mapping(poly), res, geo_json_conformant=True)
+
+# Mallas ya generadas en este proceso, por (ciudad, resolución)
+_GRIDS = {}
+
+def city_grid(city, bbox, res):
+    """H3Grid del bbox de la ciudad (cacheado por (city, res))."""
+    key = (city, res)
+    if key not in _GRIDS:
+        _GRIDS[key] = H3Grid(bbox_cells(bbox, res))
+    return _GRIDS[key]
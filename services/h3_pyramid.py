@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from services.h3_grid import cells_to_parents
+
+# Resoluciones padre por defecto (res 9 ~ 0.1 km²): res 8 ~ 0.7 km², res 7 ~ 5 km², res 6 ~ 36 km²
+PYRAMID_RESOLUTIONS = (8, 7, 6)
+
+def build_pyramid(df, sum_columns=(), mean_columns=(), id_column="h3_index", resolutions=PYRAMID_RESOLUTIONS):
+    """
+    Agrega las variables de la malla base a sus celdas padre: {res: DataFrame indexado por la
+    celda padre}. sum_columns se suman (volumen); mean_columns se promedian solo sobre las
+    celdas con valor > 0 (mismo criterio que el suavizado; 0 si no hay ninguna).
+    n_cells: cuántas celdas base tiene cada padre en los datos.
+    """
+    sum_columns, mean_columns = list(sum_columns), list(mean_columns)
+    values = df[sum_columns + mean_columns].to_numpy(dtype=np.float64)
+    present = (values[:, len(sum_columns):] > 0).astype(np.float64)
+    base = pd.DataFrame(
+        np.hstack([values[:, :len(sum_columns)], values[:, len(sum_columns):] * present, present]),
+        columns=sum_columns + [f"{c}__sum" for c in mean_columns] + [f"{c}__n" for c in mean_columns]
+    )
+
+    pyramid = {}
+    for res in resolutions:
+        parents = cells_to_parents(df[id_column].values, res)
+        grouped = base.groupby(parents, sort=True).sum()
+        level = grouped[sum_columns].copy()
+        for c in mean_columns:
+            n = grouped[f"{c}__n"].to_numpy()
+            with np.errstate(invalid="ignore", divide="ignore"):
+                level[c] = np.where(n > 0, grouped[f"{c}__sum"].to_numpy() / n, 0.0)
+        level["n_cells"] = pd.Series(parents).value_counts().reindex(level.index).to_numpy()
+        level.index.name = f"h3_r{res}"
+        pyramid[res] = level
+    return pyramid
+
+def join_pyramid(df, pyramid, id_column="h3_index"):
+    """
+    Contexto amplio para cada celda base: id del padre (h3_r<res>) y sus variables
+    (<columna>_r<res>) por cada resolución de la pirámide. Mismo índice que df.
+    """
+    out = pd.DataFrame(index=df.index)
+    for res, level in pyramid.items():
+        parents = cells_to_parents(df[id_column].values, res)
+        out[f"h3_r{res}"] = parents
+        joined = level.reindex(parents)
+        for c in level.columns:
+            out[f"{c}_r{res}"] = joined[c].to_numpy()
+    return out
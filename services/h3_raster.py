@@ -0,0 +1,130 @@
+import math
+import h3
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window
+from rasterio.warp import transform as warp_transform, transform_bounds
+from services.h3_grid import cell_boundaries, h3_vect
+
+# Sub-muestras mínimas por celda: si el píxel es más grande que celda/SAMPLES_PER_CELL, cada píxel
+# se parte en s x s sub-puntos que reparten su valor (ponderación por área).
+SAMPLES_PER_CELL = 4
+MAX_SUBSAMPLE = 16
+
+# Filas de la ventana que se procesan de una vez al construir el mapeo píxel -> celda
+ROW_BLOCK = 1024
+
+STATS = ("sum", "mean", "count")
+
+class PixelMapping:
+    """
+    Qué píxeles de una ventana del raster caen en qué celda H3 (por su centro, o por sus
+    sub-puntos si el píxel es más grueso que la celda). Se calcula una vez por malla y raster
+    y sirve para cualquier banda o fichero con la misma rejilla (mismo transform y tamaño).
+    pixels: índice plano dentro de la ventana; cells: posición en h3_ids; weights: fracción
+    del píxel que cae en la celda (1 sin sub-muestreo).
+    """
+    def __init__(self, h3_ids, window, pixels, cells, weights, subsample):
+        self.h3_ids = h3_ids
+        self.window = window
+        self.pixels = pixels
+        self.cells = cells
+        self.weights = weights
+        self.subsample = subsample
+
+    def aggregate(self, data, stat="sum", nodata=None):
+        """
+        data: array 2D leído con self.window (puede ser masked). Devuelve un array alineado con
+        h3_ids: sum/count (0 donde no hay píxeles) o mean ponderada por área (NaN sin píxeles).
+        """
+        if stat not in STATS:
+            raise ValueError(f"Estadístico no soportado: {stat} (usa {', '.join(STATS)})")
+        values = np.ma.getdata(data).ravel()[self.pixels].astype(np.float64)
+        valid = np.isfinite(values) & ~np.ma.getmaskarray(data).ravel()[self.pixels]
+        if nodata is not None:
+            valid &= values != nodata
+        n = len(self.h3_ids)
+        weights = np.where(valid, self.weights, 0.0)
+        if stat == "count":
+            return np.bincount(self.cells, weights=weights, minlength=n)
+        sums = np.bincount(self.cells, weights=np.where(valid, values, 0.0) * weights, minlength=n)
+        if stat == "sum":
+            return sums
+        counts = np.bincount(self.cells, weights=weights, minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+def _to_int(h3_ids):
+    return np.array([h3.string_to_h3(h) for h in h3_ids], dtype=np.uint64)
+
+def _window(src, h3_ids):
+    """Ventana del raster que cubre la malla (redondeada hacia fuera y recortada al raster)."""
+    rings = cell_boundaries(h3_ids)
+    bounds = rings[..., 0].min(), rings[..., 1].min(), rings[..., 0].max(), rings[..., 1].max()
+    if src.crs is not None and not src.crs.is_geographic:
+        bounds = transform_bounds("EPSG:4326", src.crs, *bounds)
+    inv = ~src.transform
+    xs, ys = zip(*(inv * (x, y) for x in (bounds[0], bounds[2]) for y in (bounds[1], bounds[3])))
+    col0, row0 = max(0, math.floor(min(xs))), max(0, math.floor(min(ys)))
+    col1, row1 = min(src.width, math.ceil(max(xs))), min(src.height, math.ceil(max(ys)))
+    return Window(col0, row0, max(0, col1 - col0), max(0, row1 - row0))
+
+def _subsample(src, res, lat):
+    """Sub-puntos por lado de píxel para que cada celda reciba al menos SAMPLES_PER_CELL."""
+    a, b, _, d, e, _ = src.transform[:6]
+    pixel_area = abs(a * e - b * d)
+    if src.crs is None or src.crs.is_geographic:
+        pixel_area *= 111320.0 ** 2 * math.cos(math.radians(lat))
+    ratio = SAMPLES_PER_CELL * pixel_area / h3.hex_area(res, unit='m^2')
+    return int(min(MAX_SUBSAMPLE, max(1, math.ceil(math.sqrt(ratio)))))
+
+def pixel_mapping(src, h3_ids):
+    """PixelMapping de una malla H3 (ids string de la misma resolución) sobre un raster abierto."""
+    h3_ids = np.asarray(h3_ids, dtype=object)
+    res = h3.h3_get_resolution(h3_ids[0])
+    targets = _to_int(h3_ids)
+    order = np.argsort(targets)
+    sorted_targets = targets[order]
+
+    window = _window(src, h3_ids)
+    rows, cols = int(window.height), int(window.width)
+    s = _subsample(src, res, float(np.mean([h3.h3_to_geo(h)[0] for h in h3_ids[:100]])))
+    offsets = (np.arange(s) + 0.5) / s
+    T = src.transform * rasterio.Affine.translation(window.col_off, window.row_off)
+
+    pixels, cells = [], []
+    for r0 in range(0, rows, ROW_BLOCK):
+        rr, cc, oy, ox = np.meshgrid(np.arange(r0, min(rows, r0 + ROW_BLOCK)), np.arange(cols),
+                                     offsets, offsets, indexing="ij")
+        x, y = cc + ox, rr + oy
+        lon = T.a * x + T.b * y + T.c
+        lat = T.d * x + T.e * y + T.f
+        if src.crs is not None and not src.crs.is_geographic:
+            lon, lat = map(np.asarray, warp_transform(src.crs, "EPSG:4326", lon.ravel(), lat.ravel()))
+        found = h3_vect.geo_to_h3(lat.ravel(), lon.ravel(), res)
+        pos = np.minimum(np.searchsorted(sorted_targets, found), len(targets) - 1)
+        hit = sorted_targets[pos] == found
+        pixels.append((rr * cols + cc).ravel()[hit])
+        cells.append(order[pos[hit]])
+
+    pixels = np.concatenate(pixels).astype(np.int64) if pixels else np.empty(0, dtype=np.int64)
+    cells = np.concatenate(cells).astype(np.int64) if cells else np.empty(0, dtype=np.int64)
+    # Sub-puntos del mismo píxel en la misma celda -> un solo par con su fracción de área
+    pairs, counts = np.unique(pixels * len(targets) + cells, return_counts=True)
+    return PixelMapping(h3_ids, window, pairs // len(targets), pairs % len(targets),
+                        counts / float(s * s), s)
+
+def aggregate_raster(raster_path, h3_ids, stat="sum", band=1, name=None):
+    """
+    Agrega una banda de un raster sobre una malla H3: cada píxel va a la celda que contiene
+    su centro (o reparte su valor por área si es más grueso que la celda).
+    Devuelve una Serie indexada por h3_id, en el orden de h3_ids.
+    """
+    h3_ids = pd.Index(h3_ids, name="h3_id")
+    if h3_ids.empty:
+        return pd.Series(dtype=np.float64, index=h3_ids, name=name or stat)
+    with rasterio.open(raster_path) as src:
+        mapping = pixel_mapping(src, h3_ids)
+        data = src.read(band, window=mapping.window, masked=True)
+    return pd.Series(mapping.aggregate(data, stat), index=h3_ids, name=name or stat)
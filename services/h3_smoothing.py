@@ -0,0 +1,176 @@
+import h3
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+KERNELS = ("rings", "gaussian", "exponential")
+
+def kernel_weights(k, kernel="gaussian", scale=None, ring_weights=None):
+    """
+    Peso por distancia en anillos (0..k) como array de k+1 valores.
+    rings: pesos explícitos {anillo: peso} (los que falten valen 0).
+    gaussian: exp(-d² / 2σ²); exponential: exp(-d / λ). scale (σ o λ) por defecto k/2.
+    """
+    d = np.arange(k + 1, dtype=np.float64)
+    if kernel == "rings":
+        if ring_weights is None:
+            raise ValueError("El kernel 'rings' necesita ring_weights={anillo: peso}")
+        return np.array([ring_weights.get(i, 0.0) for i in range(k + 1)], dtype=np.float64)
+    scale = scale if scale is not None else max(k / 2.0, 0.5)
+    if kernel == "gaussian":
+        return np.exp(-0.5 * (d / scale) ** 2)
+    if kernel == "exponential":
+        return np.exp(-d / scale)
+    raise ValueError(f"Kernel no soportado: {kernel} (usa {', '.join(KERNELS)})")
+
+def _hex_offsets(k):
+    """Desplazamientos (di, dj) en coordenadas IJ locales a distancia <= k, y su distancia."""
+    di, dj = np.meshgrid(np.arange(-k, k + 1), np.arange(-k, k + 1), indexing="ij")
+    dist = np.maximum.reduce([np.abs(di), np.abs(dj), np.abs(di - dj)])
+    keep = dist <= k
+    return di[keep], dj[keep], dist[keep]
+
+def grid_pairs(h3_ids, k):
+    """
+    Pares (i, j, distancia en anillos) de celdas de h3_ids a distancia <= k (incluida i == j).
+    Vectorizado sobre coordenadas IJ locales; si H3 no puede dar IJ (celdas muy lejanas o
+    cerca de un pentágono) se hace con k_ring_distances celda a celda.
+    """
+    n = len(h3_ids)
+    try:
+        origin = h3_ids[0]
+        ij = np.array([h3.experimental_h3_to_local_ij(origin, h) for h in h3_ids], dtype=np.int64).reshape(-1, 2)
+    except Exception:
+        return _grid_pairs_rings(h3_ids, k)
+
+    # Clave única por celda: (i, j) desplazados a no negativos y empaquetados en un int64
+    i0, j0 = ij.min(axis=0) - k
+    span = int(ij[:, 1].max() - j0 + k + 1)
+    keys = (ij[:, 0] - i0) * span + (ij[:, 1] - j0)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+
+    rows, cols, dists = [], [], []
+    for di, dj, d in zip(*_hex_offsets(k)):
+        target = keys + di * span + dj
+        pos = np.minimum(np.searchsorted(sorted_keys, target), n - 1)
+        hit = sorted_keys[pos] == target
+        rows.append(np.flatnonzero(hit))
+        cols.append(order[pos[hit]])
+        dists.append(np.full(int(hit.sum()), d, dtype=np.int16))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+def _grid_pairs_rings(h3_ids, k):
+    pos = {h: i for i, h in enumerate(h3_ids)}
+    rows, cols, dists = [], [], []
+    for i, h in enumerate(h3_ids):
+        for d, ring in enumerate(h3.k_ring_distances(h, k)):
+            for nb in ring:
+                j = pos.get(nb)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+                    dists.append(d)
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64), np.array(dists, dtype=np.int16)
+
+def ring_expand(h3_ids, k):
+    """Conjunto de celdas a distancia <= k de alguna de h3_ids (incluidas ellas)."""
+    out = set()
+    for h in h3_ids:
+        out.update(h3.k_ring(h, k))
+    return out
+
+# Pares por (clave, k): la parte cara. Los pesos del kernel se aplican encima sin recalcular.
+_PAIRS = {}
+
+def adjacency(h3_ids, weights, key=None):
+    """
+    Matriz dispersa (n x n) con W[i, j] = weights[distancia(i, j)] para las celdas de h3_ids a
+    distancia <= len(weights) - 1. Los pares se cachean por (key, k) (p. ej. key = ciudad);
+    si los ids de esa clave han cambiado, se recalculan.
+    """
+    h3_ids = np.asarray(h3_ids, dtype=object)
+    k = len(weights) - 1
+    cache_key = (key, k)
+    cached = _PAIRS.get(cache_key) if key is not None else None
+    if cached is None or not np.array_equal(cached[0], h3_ids):
+        cached = (h3_ids.copy(), *grid_pairs(h3_ids, k))
+        if key is not None:
+            _PAIRS[cache_key] = cached
+    _, rows, cols, dists = cached
+    data = np.asarray(weights, dtype=np.float64)[dists]
+    keep = data != 0
+    n = len(h3_ids)
+    return csr_matrix((data[keep], (rows[keep], cols[keep])), shape=(n, n))
+
+TIME_DECAYS = ("exponential", "gaussian", "linear")
+
+def time_decay(seconds, decay="exponential", scale_s=300.0):
+    """
+    Peso por tiempo andando: exponential exp(-t/τ), gaussian exp(-t²/2σ²) o
+    linear max(0, 1 - t/T), con scale_s = τ, σ o T en segundos.
+    """
+    t = np.asarray(seconds, dtype=np.float64)
+    if decay == "exponential":
+        return np.exp(-t / scale_s)
+    if decay == "gaussian":
+        return np.exp(-0.5 * (t / scale_s) ** 2)
+    if decay == "linear":
+        return np.clip(1.0 - t / scale_s, 0.0, None)
+    raise ValueError(f"Decaimiento no soportado: {decay} (usa {', '.join(TIME_DECAYS)})")
+
+def walk_adjacency(walk_matrix, h3_ids, decay="exponential", scale_s=300.0, max_seconds=None):
+    """
+    Como adjacency() pero con pesos por tiempo andando real (WalkMatrix de services/walk_matrix):
+    W[i, j] = time_decay(segundos de i a j) para los pares de la matriz (y <= max_seconds).
+    Un río o una autopista sin cruce quedan fuera aunque estén a un anillo.
+    Las celdas que no están en la matriz solo se pesan a sí mismas (peso 1).
+    """
+    n = len(h3_ids)
+    idx = walk_matrix.index(np.asarray(h3_ids, dtype=object))
+    present = np.flatnonzero(idx >= 0)
+    sub = walk_matrix.csr[idx[present]][:, idx[present]].tocoo()
+    rows, cols, secs = present[sub.row], present[sub.col], sub.data.astype(np.float64)
+    keep = rows != cols
+    if max_seconds is not None:
+        keep &= secs <= max_seconds
+    data = time_decay(secs[keep], decay, scale_s)
+    # Diagonal explícita (t = 0) para todas: el propio hexágono siempre cuenta
+    diag = np.arange(n)
+    W = csr_matrix((np.concatenate([data, np.full(n, time_decay(0.0, decay, scale_s))]),
+                    (np.concatenate([rows[keep], diag]), np.concatenate([cols[keep], diag]))), shape=(n, n))
+    W.eliminate_zeros()
+    return W
+
+def smooth(df, W, sum_columns=(), mean_columns=(), suffix="_smooth"):
+    """
+    Suavizado de un DataFrame alineado con la matriz W (una fila por celda, mismo orden).
+    sum_columns: suma ponderada del entorno (volumen: "cuanto más alrededor, mejor").
+    mean_columns: media ponderada solo de los vecinos con valor > 0 (cualidad: "nivel medio
+    de la zona"); 0 si no hay ninguno. Todas las columnas en un producto disperso por grupo.
+    Las columnas pueden ir como lista (salida <columna><suffix>) o como {columna: salida}.
+    Devuelve un DataFrame con las columnas suavizadas, mismo índice que df.
+    """
+    out = pd.DataFrame(index=df.index)
+    sum_names = _output_names(sum_columns, suffix)
+    mean_names = _output_names(mean_columns, suffix)
+    if sum_names:
+        X = df[list(sum_names)].to_numpy(dtype=np.float64)
+        sums = W @ X
+        for c, name in enumerate(sum_names.values()):
+            out[name] = sums[:, c]
+    if mean_names:
+        X = df[list(mean_names)].to_numpy(dtype=np.float64)
+        present = (X > 0).astype(np.float64)
+        num = W @ (X * present)
+        den = W @ present
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(den > 0, num / den, 0.0)
+        for c, name in enumerate(mean_names.values()):
+            out[name] = means[:, c]
+    return out
+
+def _output_names(columns, suffix):
+    if isinstance(columns, dict):
+        return dict(columns)
+    return {c: f"{c}{suffix}" for c in columns}
@@ -0,0 +1,159 @@
+import os
+import glob
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import h3
+from shapely import wkb
+
+# Resolución H3 para "snapear" el origen (res 12 ~ 9 m de lado): dos puntos en la
+# misma celda comparten isócrona.
+CACHE_H3_RES = 12
+
+def osrm_fingerprint(osrm_data_dir, profile="foot"):
+    """
+    Huella del dataset de OSRM (nombre, tamaño y fecha de los ficheros input.osrm*).
+    Si se regenera el grafo de docker/osrm_data, la huella cambia y la caché se invalida.
+    """
+    files = sorted(glob.glob(os.path.join(osrm_data_dir, profile, "*.osrm*")))
+    if not files:
+        # Sin ficheros (OSRM remoto, ruta mal puesta...) la huella no cambia nunca
+        print(f"⚠️ No hay ficheros *.osrm* en {os.path.join(osrm_data_dir, profile)}: "
+              f"la caché no se invalidará si cambian los datos de OSRM.")
+    h = hashlib.sha1(profile.encode())
+    for f in files:
+        st = os.stat(f)
+        h.update(f"{os.path.basename(f)}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:16]
+
+class IsochroneCache:
+    """
+    Caché de dos niveles para isócronas: LRU en memoria delante de un SQLite en disco.
+    Clave: (celda H3 del origen, minutos, perfil, variante) + huella del dataset OSRM.
+    """
+    def __init__(self, path, osrm_data_dir, profile="foot", memory_items=20000, max_bytes=512 * 1024 ** 2):
+        self.path = path
+        self.profile = profile
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.fingerprint = osrm_fingerprint(osrm_data_dir, profile)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS isochrones (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                geom BLOB,
+                size INTEGER,
+                last_access REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_iso_access ON isochrones (last_access);")
+
+        # Invalidación: fuera todo lo calculado con otro dataset de OSRM
+        with self._conn:
+            stale = self._conn.execute("DELETE FROM isochrones WHERE fingerprint != ?", (self.fingerprint,)).rowcount
+        if stale:
+            print(f"♻️ Caché de isócronas: {stale} entradas invalidadas (datos OSRM cambiados).")
+
+        # Bytes en disco: se suma una vez y luego se lleva la cuenta en cada put / eviction
+        self._bytes = self._total_bytes()
+
+    def key(self, lat, lon, minutes, variant="rays24"):
+        cell = h3.geo_to_h3(lat, lon, CACHE_H3_RES)
+        return f"{self.profile}:{cell}:{minutes}:{variant}"
+
+    def get_many(self, keys):
+        """Devuelve {key: geometry} con los aciertos (memoria primero, luego disco)."""
+        found = {}
+        missing = []
+        with self._lock:
+            for k in keys:
+                if k in self._memory:
+                    self._memory.move_to_end(k)
+                    found[k] = self._memory[k]
+                else:
+                    missing.append(k)
+
+            # SQLite limita el número de parámetros por consulta
+            now = time.time()
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, geom FROM isochrones WHERE key IN ({marks}) AND fingerprint = ?",
+                    (*chunk, self.fingerprint)
+                ).fetchall()
+                with self._conn:
+                    self._conn.executemany("UPDATE isochrones SET last_access = ? WHERE key = ?",
+                                           [(now, k) for k, _ in rows])
+                for k, blob in rows:
+                    geom = wkb.loads(blob)
+                    found[k] = geom
+                    self._remember(k, geom)
+        return found
+
+    def put_many(self, items):
+        """items: {key: geometry}"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        with self._lock:
+            for k, geom in items.items():
+                blob = wkb.dumps(geom)
+                rows.append((k, self.fingerprint, blob, len(blob), now))
+                self._remember(k, geom)
+            # Las claves que ya estaban se reemplazan: su tamaño anterior deja de contar
+            keys = list(items)
+            replaced = 0
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                replaced += self._conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM isochrones WHERE key IN ({marks})", chunk
+                ).fetchone()[0]
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO isochrones VALUES (?, ?, ?, ?, ?)", rows)
+            self._bytes += sum(r[3] for r in rows) - replaced
+            self._evict()
+
+    def _remember(self, k, geom):
+        self._memory[k] = geom
+        self._memory.move_to_end(k)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _total_bytes(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM isochrones").fetchone()[0]
+
+    def _evict(self):
+        # Eviction por tamaño: borramos lo menos usado hasta quedar al 90% del límite
+        if self._bytes <= self.max_bytes:
+            return
+        # Solo al pasar el límite se suma la tabla entera: otros procesos también escriben en ella
+        total = self._bytes = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for k, size in self._conn.execute("SELECT key, size FROM isochrones ORDER BY last_access"):
+            doomed.append((k,))
+            freed += size
+            if freed >= target:
+                break
+        with self._conn:
+            self._conn.executemany("DELETE FROM isochrones WHERE key = ?", doomed)
+        self._bytes -= freed
+        for (k,) in doomed:
+            self._memory.pop(k, None)
+
+    def close(self):
+        self._conn.close()
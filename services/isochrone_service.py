@@ -1,55 +1,525 @@
-import requests
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import h3
 import numpy as np
-from shapely.geometry import Polygon
-import geopandas as gpd
+import shapely
 from sqlalchemy import create_engine
+from services.osrm_client import OSRMClient, OSRMRequestError
+from services.copy_writer import CopyWriter
+from services.street_graph import graph_batch_durations
+from services.osrm_hints import point_key
+
+# Número de rayos por isócrona (el primero y el último coinciden y cierran el polígono)
+N_RAYS = 24
+
+# osrm-routed rechaza /table si sources x destinations > max_table_size^2 (por defecto 100)
+DEFAULT_MAX_TABLE_SIZE = 100
+
+# Backend 'graph': orígenes por Dijkstra y corte de búsqueda (x veces los segundos pedidos).
+# Los extremos de los rayos quedan más lejos de lo que se anda en 'minutes', así que hay
+# que explorar más allá del umbral para poder interpolar el ratio como con OSRM.
+GRAPH_BATCH_SIZE = 64
+GRAPH_LIMIT_FACTOR = 4
+
+# Modo adaptativo: mitad del presupuesto en rayos gruesos, el resto se reparte donde el
+# error estimado entre rayos vecinos supera la tolerancia (metros).
+ADAPTIVE_TOLERANCE_M = 20
+ADAPTIVE_COARSE_SHARE = 0.5
+M_PER_DEG = 111132
+
+# Catchments H3: resolución de la malla y distancia entre centroides vecinos (~302 m en res 9)
+CELLS_RES = 9
+CELL_SPACING_M = h3.edge_length(CELLS_RES, 'm') * math.sqrt(3)
+
+def as_thresholds(minutes):
+    """Admite un umbral (10) o varios ([5, 10, 15]); devuelve la lista ordenada sin duplicados."""
+    if isinstance(minutes, (list, tuple, set, np.ndarray)):
+        return sorted({int(m) for m in minutes})
+    return [int(minutes)]
+
+def bounded_map(pool, fn, args, window):
+    """
+    Como pool.map(fn, *zip(*args)) pero con como mucho 'window' tareas enviadas a la vez:
+    la siguiente se envía al recoger un resultado, así los resultados no se acumulan si el
+    consumidor va más lento. Si se cierra el generador, las tareas sin empezar se cancelan.
+    """
+    args = iter(args)
+    pending = deque(pool.submit(fn, *a) for _, a in zip(range(window), args))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            nxt = next(args, None)
+            if nxt is not None:
+                pending.append(pool.submit(fn, *nxt))
+            yield result
+    finally:
+        for f in pending:
+            f.cancel()
+
+def uncompact_cells(cells, res=CELLS_RES):
+    """Expande un catchment compactado (uint64) a sus celdas de resolución 'res'."""
+    hexes = h3.uncompact({h3.h3_to_string(int(c)) for c in cells}, res)
+    return np.sort(np.array([h3.string_to_h3(x) for x in hexes], dtype=np.uint64))
 
 class IsochroneService:
-    def __init__(self, db_url, osrm_url="http://localhost:5001"):
+    def __init__(self, db_url, osrm_url="http://localhost:5001", max_table_size=DEFAULT_MAX_TABLE_SIZE,
+                 max_in_flight=1, retries=3, cache=None, backend="osrm", graph_dir=None, workers=1,
+                 hints=None, max_snap_m=None):
+        """
+        max_in_flight: llamadas /table simultáneas contra OSRM. Para aprovechar todos los
+        hilos de osrm-routed, ponerlo al número de threads del contenedor (-t).
+        cache: IsochroneCache opcional; los orígenes ya calculados no vuelven a OSRM.
+        backend: 'osrm' (servidor HTTP) o 'graph' (grafo local compilado con street_graph,
+        sin docker). workers: procesos para el backend 'graph'.
+        hints: HintCache opcional; los orígenes van a /table con su hint de /nearest (OSRM no
+        los vuelve a snapear) y los que snapean a más de max_snap_m metros no se rutan.
+        """
+        if backend not in ("osrm", "graph"):
+            raise ValueError(f"Backend desconocido: {backend}")
+        if backend == "graph" and not graph_dir:
+            raise ValueError("El backend 'graph' necesita graph_dir (ver etl/osm_Data/01_build_street_graph.py).")
+
         self.engine = create_engine(db_url)
         self.osrm_url = osrm_url
+        self.max_table_size = max_table_size
+        self.max_in_flight = max(1, max_in_flight)
+        self.osrm = OSRMClient(osrm_url, profile="foot", max_in_flight=self.max_in_flight, retries=retries)
+        self.cache = cache
+        self.backend = backend
+        self.graph_dir = graph_dir
+        self.workers = max(1, workers)
+        self.hints = hints
+        self.max_snap_m = max_snap_m
+
+    def auto_batch_size(self, dests_per_origin=N_RAYS):
+        """
+        Máximo de orígenes por llamada /table sin pasar el límite de OSRM.
+        Con B orígenes pedimos B sources x (B * dests_per_origin) destinations.
+        """
+        if self.backend == "graph":
+            return GRAPH_BATCH_SIZE
+        return max(1, int(self.max_table_size / math.sqrt(dests_per_origin)))
+
+    @staticmethod
+    def _origins(batch):
+        return np.array([(p['lon'], p['lat']) for p in batch], dtype=np.float64).reshape(-1, 2)
+
+    def _ray_endpoints(self, origins, minutes, angles=None, fracs=None):
+        """
+        Extremos de los rayos como array (orígenes, rayos, 2) lon/lat.
+        angles / fracs (fracción del radio): (rayos,) comunes a todos o (orígenes, rayos).
+        """
+        # Radio adaptativo según los minutos (aprox 100m por minuto)
+        radius = 0.0009 * minutes
+        angles = np.linspace(0, 2 * np.pi, N_RAYS) if angles is None else np.asarray(angles, dtype=np.float64)
+        fracs = np.ones_like(angles) if fracs is None else np.asarray(fracs, dtype=np.float64)
+        offsets = (radius * fracs)[..., None] * np.stack([np.sin(angles), np.cos(angles)], axis=-1)
+        return origins[:, None, :] + offsets
+
+    def _with_hints(self, points_list, id_column, on_skip=None):
+        """
+        Añade 'hint' a cada origen y quita los que snapean demasiado lejos de la red.
+        on_skip: función que recibe [(id, snap_m)] de los omitidos (para marcarlos y no reintentarlos).
+        """
+        if self.hints is None or self.backend != "osrm" or not points_list:
+            return points_list
+        keys = [f"h3:{p['id']}" if id_column == "h3_id" else point_key(p['lat'], p['lon']) for p in points_list]
+        found = self.hints.lookup(self.osrm, [(k, p['lon'], p['lat']) for k, p in zip(keys, points_list)])
+
+        kept, skipped = [], []
+        for p, (hint, snap_m) in zip(points_list, found):
+            if self.max_snap_m is not None and snap_m is not None and snap_m > self.max_snap_m:
+                skipped.append((p['id'], snap_m))
+                continue
+            kept.append({**p, 'hint': hint})
+        if skipped:
+            print(f"🚫 {len(skipped)} orígenes snapean a más de {self.max_snap_m} m de la red: se omiten.")
+            if on_skip is not None:
+                on_skip(skipped)
+        return kept
+
+    @staticmethod
+    def _batch_hints(batch):
+        hints = [p.get('hint', '') for p in batch]
+        return hints if any(hints) else None
+
+    def _table_batch(self, origins, destinations, hints=None):
+        """
+        Una sola llamada /table para varios orígenes.
+        Coordenadas: [orígenes..., destinos del origen 0..., destinos del origen 1..., ...]
+        destinations: array (n, k, 2) o lista de arrays (k_i, 2).
+        Devuelve las duraciones de cada origen a sus destinos (NaN si OSRM no llega):
+        array (n, k) si todos tienen los mismos destinos, lista de arrays si no.
+        hints: uno por origen ('' sin hint); los destinos siempre los snapea OSRM.
+        """
+        n = len(origins)
+        sizes = [len(d) for d in destinations]
+        stacked = np.concatenate([origins] + [np.asarray(d).reshape(-1, 2) for d in destinations])
+        coords = [f"{x},{y}" for x, y in stacked.tolist()]
+        if hints is not None:
+            hints = list(hints) + [""] * (len(coords) - n)
+
+        durations = self.osrm.table(coords, sources=range(n), destinations=range(n, len(coords)), timeout=5 + n, hints=hints)
+        matrix = np.array(durations, dtype=np.float64).reshape(n, -1)  # None -> NaN
+
+        # Cada origen solo necesita su bloque diagonal de la matriz
+        if len(set(sizes)) == 1:
+            k = sizes[0]
+            return matrix.reshape(n, n, k)[np.arange(n), np.arange(n)]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        return [matrix[i, offsets[i]:offsets[i + 1]] for i in range(n)]
+
+    def _graph_args(self, origins, destinations, minutes, limit_factor=GRAPH_LIMIT_FACTOR):
+        return self.graph_dir, origins, destinations, minutes * 60 * limit_factor
+
+    def _durations(self, origins, destinations, minutes, hints=None):
+        if self.backend == "graph":
+            return graph_batch_durations(*self._graph_args(origins, destinations, minutes))
+        return self._table_batch(origins, destinations, hints)
 
-    def calculate_and_save(self, points_list, minutes, table_name=None, schema="analytics", id_column="origin_id"):
+    @staticmethod
+    def _build_polygons(origins, endpoints, durations, thresholds):
+        """
+        Todos los polígonos del lote de una vez: (umbrales, orígenes) con una sola llamada
+        a shapely.polygons. ratio = min(1, s / d); sin ruta (NaN) o d == 0 -> 0.1.
+        """
+        seconds = np.asarray(thresholds, dtype=np.float64)[:, None, None] * 60
+        d = np.asarray(durations, dtype=np.float64)[None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(d > 0, np.minimum(1, seconds / d), 0.1)
+        points = origins[None, :, None, :] + (endpoints - origins[:, None, :])[None] * ratio[..., None]
+        return shapely.polygons(points)
+
+    def _route_batch(self, batch, thresholds, id_column):
+        # Un solo pase de rutado dimensionado para el umbral mayor
+        minutes = thresholds[-1]
+        origins = self._origins(batch)
+        endpoints = self._ray_endpoints(origins, minutes)
+
+        try:
+            all_durations = self._durations(origins, endpoints, minutes, self._batch_hints(batch))
+        except OSRMRequestError as e:
+            # Solo se parte el lote si OSRM rechaza la petición; si no responde (o falla el
+            # grafo) el error sube y quien llama decide (p.ej. la cola reintenta la unidad)
+            if len(batch) == 1:
+                print(f"⚠️ Error en punto {batch[0]['id']}: {e}")
+                return []
+            # Un origen mal "snapeado" no debe tumbar todo el lote: reintentamos uno a uno
+            print(f"⚠️ Error en lote de {len(batch)} puntos ({e}). Reintentando individualmente...")
+            results = []
+            for p in batch:
+                results.extend(self._route_batch([p], thresholds, id_column))
+            return results
+
+        return self._rows(batch, origins, endpoints, all_durations, thresholds, id_column)
+
+    def _rows(self, batch, origins, endpoints, all_durations, thresholds, id_column):
+        # Del mismo vector de duraciones salen todos los anillos (5, 10, 15...)
+        polygons = self._build_polygons(origins, endpoints, all_durations, thresholds)
+        return [
+            {id_column: p['id'], 'minutes': m, 'geometry': polygons[t, i]}
+            for i, p in enumerate(batch)
+            for t, m in enumerate(thresholds)
+        ]
+
+    def _compute(self, points_list, thresholds, id_column, batch_size, adaptive=None, on_skip=None):
+        """
+        Generador: devuelve las filas lote a lote, para que se puedan ir escribiendo
+        mientras se rutan los siguientes. adaptive: None (24 rayos fijos) o (tolerance_m, ray_budget).
+        """
+        points_list = self._with_hints(points_list, id_column, on_skip)
+        batches = [points_list[i:i + batch_size] for i in range(0, len(points_list), batch_size)]
+
+        if adaptive:
+            route = lambda b: self._adaptive_batch(b, thresholds, id_column, *adaptive)
+        else:
+            route = lambda b: self._route_batch(b, thresholds, id_column)
+
+        if self.backend == "graph" and self.workers > 1 and len(batches) > 1 and not adaptive:
+            # Sin HTTP: los Dijkstra se reparten entre procesos que abren el grafo con mmap
+            minutes = thresholds[-1]
+            origins = [self._origins(b) for b in batches]
+            endpoints = [self._ray_endpoints(o, minutes) for o in origins]
+            args = [self._graph_args(o, e, minutes) for o, e in zip(origins, endpoints)]
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                all_durations = bounded_map(pool, graph_batch_durations, args, self.workers)
+                try:
+                    for b, o, e, durs in zip(batches, origins, endpoints, all_durations):
+                        yield self._rows(b, o, e, durs, thresholds, id_column)
+                finally:
+                    all_durations.close()
+        elif self.backend == "osrm" and self.max_in_flight > 1 and len(batches) > 1:
+            # Como mucho max_in_flight lotes en vuelo, en el orden de entrada
+            with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+                routed = bounded_map(pool, route, ((b,) for b in batches), self.max_in_flight)
+                try:
+                    yield from routed
+                finally:
+                    routed.close()
+        else:
+            for batch in batches:
+                yield route(batch)
+
+    def _compute_cached(self, points_list, thresholds, id_column, batch_size, adaptive=None, on_skip=None):
+        # Los polígonos del grafo local y los de OSRM no son intercambiables.
+        # Los anillos de un pase multi-umbral usan rayos del umbral mayor: la variante lo recoge.
+        variant = "rays24" if self.backend == "osrm" else "graph-rays24"
+        if adaptive:
+            variant = variant.replace("rays24", f"adaptive{adaptive[1]}-t{adaptive[0]}")
+        if len(thresholds) > 1:
+            variant += f"-r{thresholds[-1]}"
+        keys = [[self.cache.key(p['lat'], p['lon'], m, variant) for m in thresholds] for p in points_list]
+        hits = self.cache.get_many([k for ks in keys for k in ks])
+
+        # Un origen solo se salta si tiene en caché todos sus anillos
+        pending = [p for p, ks in zip(points_list, keys) if not all(k in hits for k in ks)]
+        if len(pending) < len(points_list):
+            print(f"⚡ Caché: {len(points_list) - len(pending)}/{len(points_list)} isócronas sin pasar por OSRM.")
+
+        yield [
+            {id_column: p['id'], 'minutes': m, 'geometry': hits[k]}
+            for p, ks in zip(points_list, keys) if all(k in hits for k in ks)
+            for m, k in zip(thresholds, ks)
+        ]
+
+        key_by_id = {(p['id'], m): k for p, ks in zip(points_list, keys) for m, k in zip(thresholds, ks)}
+        for fresh in (self._compute(pending, thresholds, id_column, batch_size, adaptive, on_skip) if pending else []):
+            self.cache.put_many({key_by_id[(r[id_column], r['minutes'])]: r['geometry'] for r in fresh})
+            yield fresh
+
+    def calculate_and_save(self, points_list, minutes, table_name=None, schema="analytics", id_column="origin_id", batch_size=None,
+                           adaptive=False, tolerance_m=ADAPTIVE_TOLERANCE_M, ray_budget=N_RAYS, writer=None,
+                           skip_conflicts=False, heartbeat=None, on_skip=None):
         """
         points_list: [{'id': 'X', 'lat': 0.0, 'lon': 0.0}]
+        minutes: un umbral (10) o varios ([5, 10, 15]). Con varios se hace un único pase de
+        rutado (radio del umbral mayor) y se escribe una fila por anillo en la misma tabla.
         id_column: 'origin_id' para clientes, 'h3_id' para ciudades.
+        batch_size: orígenes por llamada /table (None = el máximo que admite OSRM, 1 = modo clásico).
+        adaptive: rayos gruesos (ray_budget / 2) y un segundo /table que refina solo los huecos
+        entre rayos vecinos cuyo error estimado supera tolerance_m (metros).
+        Nunca pide más de ray_budget destinos por origen (24 por defecto, como el modo fijo).
+        writer: CopyWriter propio (p.ej. hacia otra tabla); por defecto se abre uno hacia
+        schema.table_name. Los lotes se escriben con COPY binario mientras se rutan los siguientes.
+        skip_conflicts: descarta las filas que chocan con un índice único de la tabla (solo con
+        el writer propio). heartbeat: función sin argumentos llamada tras cada lote escrito.
+        on_skip: función que recibe [(id, snap_m)] de los orígenes omitidos por snapear a más
+        de max_snap_m metros de la red.
+        """
+        thresholds = as_thresholds(minutes)
+
+        # Generar nombre de tabla si no se da uno (ej: catchment_10m, catchment_5_10_15m)
+        target_table = table_name if table_name else f"catchment_{'_'.join(map(str, thresholds))}m"
+
+        if adaptive:
+            adaptive = (tolerance_m, ray_budget)
+            max_batch = self.auto_batch_size(max(4, int(ray_budget * ADAPTIVE_COARSE_SHARE)))
+        else:
+            adaptive = None
+            max_batch = self.auto_batch_size()
+        batch_size = min(batch_size or max_batch, max_batch)
+
+        if self.cache is None:
+            chunks = self._compute(points_list, thresholds, id_column, batch_size, adaptive, on_skip)
+        else:
+            chunks = self._compute_cached(points_list, thresholds, id_column, batch_size, adaptive, on_skip)
+
+        return self._write(chunks, writer, target_table, schema, skip_conflicts, heartbeat)
+
+    def _write(self, chunks, writer, table_name, schema, skip_conflicts=False, heartbeat=None):
+        own = writer is None
+        if own:
+            writer = CopyWriter(self.engine, table_name, schema=schema, skip_conflicts=skip_conflicts)
+        n = 0
+        try:
+            for rows in chunks:
+                writer.write(rows)
+                n += len(rows)
+                if heartbeat is not None:
+                    heartbeat()
+        except BaseException:
+            # Se cierra igual, pero el error que sube es el del rutado, no el del writer
+            if own:
+                try:
+                    writer.close()
+                except Exception as e:
+                    print(f"⚠️ Error cerrando la escritura en {schema}.{table_name}: {e}")
+            raise
+        if own:
+            writer.close()
+        return n
+
+    # ------------------------------------------------------------------
+    # MODO ADAPTATIVO: rayos gruesos + refinado en un segundo /table
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _reach_frac(samples, seconds):
+        """
+        samples: [(fracción del radio, segundos)] medidos sobre un mismo rayo.
+        Interpola el alcance por tramos (origen, muestras intermedias, extremo) en vez
+        de suponer que el tiempo crece lineal hasta el extremo.
+        """
+        valid = sorted((f, d) for f, d in samples if d is not None and d > 0)
+        if not valid:
+            return 0.1
+        fracs = np.array([0.0] + [f for f, _ in valid])
+        durs = np.maximum.accumulate(np.array([0.0] + [d for _, d in valid]))
+        if seconds >= durs[-1]:
+            # Más allá de la última muestra extrapolamos a su velocidad media (tope: el radio)
+            return min(1.0, fracs[-1] * seconds / durs[-1])
+        return float(np.interp(seconds, durs, fracs))
+
+    def _refine_plan(self, p, angles, durations, minutes, tolerance_m, extra):
+        """
+        Destinos del segundo pase para un origen: un rayo bisector en cada hueco entre rayos
+        vecinos cuyo error estimado supera tolerance_m (salto de alcance entre ellos o flecha
+        de la cuerda del polígono), de mayor a menor error y hasta agotar el presupuesto.
+        El nuevo destino se pone en el borde estimado (media del alcance de los vecinos) y no
+        en el extremo del rayo: así la interpolación lineal se apoya en una muestra cercana
+        al umbral en vez de suponer tiempo lineal a lo largo de todo el rayo.
+        Devuelve [(ángulo, fracción del radio)].
         """
-        # Generar nombre de tabla si no se da uno (ej: catchment_10m)
-        target_table = table_name if table_name else f"catchment_{minutes}m"
-        
-        results = []
         seconds = minutes * 60
-        
-        for p in points_list:
-            # Radio adaptativo según los minutos (aprox 100m por minuto)
-            radius = 0.0009 * minutes 
-            angles = np.linspace(0, 2 * np.pi, 24)
-            destinations = [f"{p['lon'] + (radius * np.sin(a))},{p['lat'] + (radius * np.cos(a))}" for a in angles]
-            
-            url = f"{self.osrm_url}/table/v1/foot/{p['lon']},{p['lat']};{';'.join(destinations)}?sources=0"
-            
-            try:
-                r = requests.get(url, timeout=5).json()
-                durations = r['durations'][0][1:]
-                poly_points = []
-                for i, d in enumerate(durations):
-                    t_lon, t_lat = map(float, destinations[i].split(','))
-                    ratio = min(1, seconds / d) if d and d > 0 else 0.1
-                    poly_points.append((
-                        p['lon'] + (t_lon - p['lon']) * ratio, 
-                        p['lat'] + (t_lat - p['lat']) * ratio
-                    ))
-                
-                results.append({
-                    id_column: p['id'],
-                    'minutes': minutes,
-                    'geometry': Polygon(poly_points)
-                })
-            except Exception as e:
-                print(f"⚠️ Error en punto {p['id']}: {e}")
-
-        if results:
-            gdf = gpd.GeoDataFrame(results, crs="EPSG:4326")
-            gdf.to_postgis(target_table, self.engine, schema=schema, if_exists='append', index=False)
-            return len(results)
-        return 0
\ No newline at end of file
+        radius_m = 0.0009 * minutes * M_PER_DEG
+        # Metros por grado a lo largo de cada rayo (lon y lat no miden igual)
+        scale = np.hypot(np.sin(angles) * np.cos(np.radians(p['lat'])), np.cos(angles))
+        fracs = np.array([self._reach_frac([(1.0, d)], seconds) for d in durations])
+        reach_m = fracs * radius_m * scale
+
+        n = len(angles)
+        next_reach = np.roll(reach_m, -1)
+        jump = np.abs(reach_m - next_reach)
+        sag = (reach_m + next_reach) / 2 * (1 - np.cos(np.pi / n))
+        error = np.maximum(jump, sag)
+
+        gaps = [i for i in np.argsort(-error) if error[i] > tolerance_m][:extra]
+        return [(angles[i] + np.pi / n, (fracs[i] + fracs[(i + 1) % n]) / 2) for i in gaps]
+
+    def _adaptive_batch(self, batch, thresholds, id_column, tolerance_m, ray_budget):
+        minutes = thresholds[-1]
+        n_coarse = max(4, int(ray_budget * ADAPTIVE_COARSE_SHARE))
+        extra = ray_budget - n_coarse
+        coarse = np.linspace(0, 2 * np.pi, n_coarse, endpoint=False)
+
+        origins = self._origins(batch)
+        try:
+            hints = self._batch_hints(batch)
+            first = self._durations(origins, self._ray_endpoints(origins, minutes, coarse), minutes, hints)
+
+            plans = [self._refine_plan(p, coarse, d, minutes, tolerance_m, extra) for p, d in zip(batch, first)]
+            second_dests = [
+                self._ray_endpoints(origins[i:i + 1], minutes, [a for a, _ in plan], [f for _, f in plan])[0]
+                for i, plan in enumerate(plans)
+            ]
+
+            if any(len(d) for d in second_dests):
+                second = self._durations(origins, second_dests, minutes, hints)
+            else:
+                second = [[] for _ in batch]
+        except OSRMRequestError as e:
+            if len(batch) == 1:
+                print(f"⚠️ Error en punto {batch[0]['id']}: {e}")
+                return []
+            print(f"⚠️ Error en lote de {len(batch)} puntos ({e}). Reintentando individualmente...")
+            results = []
+            for p in batch:
+                results.extend(self._adaptive_batch([p], thresholds, id_column, tolerance_m, ray_budget))
+            return results
+
+        results = []
+        radius = 0.0009 * minutes
+        coords, ring_ids = [], []
+        for p, d1, plan, d2 in zip(batch, first, plans, second):
+            # Muestras por rayo: {ángulo: [(fracción, segundos), ...]}
+            rays = {a: [(1.0, d)] for a, d in zip(coarse, d1)}
+            for (a, f), d in zip(plan, d2):
+                rays.setdefault(a, []).append((f, d))
+
+            angles = np.array(sorted(rays))
+            for m in thresholds:
+                fracs = np.array([self._reach_frac(rays[a], m * 60) for a in angles])
+                coords.append(np.column_stack([p['lon'] + radius * fracs * np.sin(angles),
+                                               p['lat'] + radius * fracs * np.cos(angles)]))
+                ring_ids.append(np.full(len(angles), len(results)))
+                results.append({id_column: p['id'], 'minutes': m})
+        if not results:
+            return results
+
+        # Cada origen tiene su número de rayos: todos los anillos en una llamada con indices
+        rings = shapely.linearrings(np.concatenate(coords), indices=np.concatenate(ring_ids))
+        for row, polygon in zip(results, shapely.polygons(rings)):
+            row['geometry'] = polygon
+        return results
+
+    # ------------------------------------------------------------------
+    # CATCHMENTS H3: conjunto de celdas alcanzables en vez de polígono
+    # ------------------------------------------------------------------
+    def _candidate_cells(self, p, minutes):
+        # Mismo radio de búsqueda que los rayos (aprox 100m por minuto)
+        k = max(1, math.ceil(100 * minutes / CELL_SPACING_M))
+        origin = h3.geo_to_h3(p['lat'], p['lon'], CELLS_RES)
+        cells = [origin] + sorted(h3.k_ring(origin, k) - {origin})
+        return origin, cells
+
+    def _reachable_batch(self, batch, thresholds):
+        minutes = thresholds[-1]
+        candidates = [self._candidate_cells(p, minutes) for p in batch]
+        # Centroides como (lon, lat); h3 los da en (lat, lon)
+        destinations = [np.array([h3.h3_to_geo(c) for c in cells])[:, ::-1] for _, cells in candidates]
+        origins = self._origins(batch)
+
+        if self.backend == "graph":
+            all_durations = graph_batch_durations(*self._graph_args(origins, destinations, minutes, limit_factor=1))
+        else:
+            all_durations = self._table_batch(origins, destinations, self._batch_hints(batch))
+
+        results = []
+        for (origin, cells), durations in zip(candidates, all_durations):
+            rings = []
+            for m in thresholds:
+                # La celda del propio origen siempre cuenta (aunque su centroide no "snapee")
+                reached = {origin} | {c for c, d in zip(cells, durations) if d <= m * 60}
+                compact = np.sort(np.array([h3.string_to_h3(c) for c in h3.compact(reached)], dtype=np.uint64))
+                rings.append((m, compact, len(reached)))
+            results.append(rings)
+        return results
+
+    def _cells_batch(self, batch, thresholds, id_column):
+        try:
+            reached = self._reachable_batch(batch, thresholds)
+        except OSRMRequestError as e:
+            if len(batch) == 1:
+                print(f"⚠️ Error en punto {batch[0]['id']}: {e}")
+                return []
+            print(f"⚠️ Error en lote de {len(batch)} puntos ({e}). Reintentando individualmente...")
+            rows = []
+            for p in batch:
+                rows.extend(self._cells_batch([p], thresholds, id_column))
+            return rows
+
+        return [
+            {id_column: p['id'], 'minutes': m, 'n_cells': n_cells, 'cells': [int(c) for c in cells]}
+            for p, rings in zip(batch, reached)
+            for m, cells, n_cells in rings
+        ]
+
+    def calculate_cells_and_save(self, points_list, minutes, table_name="catchment_cells", schema="core", id_column="h3_id", batch_size=None,
+                                 writer=None, skip_conflicts=False, heartbeat=None, on_skip=None):
+        """
+        Catchment como conjunto compactado de celdas H3 (res 9) cuyo centroide se alcanza
+        andando en 'minutes'. Se guarda como BIGINT[] (los índices H3 caben en int64):
+        las sumas de población/renta/competencia pasan a ser cruces por id, sin ST_Intersects.
+        Para volver a res 9: uncompact_cells(cells).
+        minutes admite una lista de umbrales; writer, skip_conflicts, heartbeat y on_skip, igual
+        que calculate_and_save.
+        """
+        thresholds = as_thresholds(minutes)
+        k = max(1, math.ceil(100 * thresholds[-1] / CELL_SPACING_M))
+        n_dests = 3 * k * (k + 1) + 1
+        batch_size = min(batch_size or self.auto_batch_size(n_dests), self.auto_batch_size(n_dests))
+
+        points_list = self._with_hints(points_list, id_column, on_skip)
+        chunks = (self._cells_batch(points_list[i:i + batch_size], thresholds, id_column)
+                  for i in range(0, len(points_list), batch_size))
+        return self._write(chunks, writer, table_name, schema, skip_conflicts, heartbeat)
@@ -0,0 +1,137 @@
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# Códigos de OSRM que indican un problema de la petición (no tiene sentido reintentar)
+NON_RETRYABLE_CODES = {"InvalidUrl", "InvalidService", "InvalidVersion", "InvalidOptions",
+                       "InvalidQuery", "InvalidValue", "NoSegment", "TooBig", "NoTable"}
+
+class OSRMError(RuntimeError):
+    pass
+
+class OSRMRequestError(OSRMError):
+    """OSRM respondió, pero rechaza la petición (coordenada sin vía cercana, tabla demasiado grande...)."""
+    pass
+
+class CircuitBreaker:
+    """
+    Cortocircuito para OSRM: tras 'failures' fallos seguidos se abre y allow() devuelve False
+    durante 'cooldown' segundos (el llamador usa su plan B sin pagar timeouts). Pasado ese
+    tiempo deja pasar una petición de prueba: si va bien se cierra, si falla vuelve a abrirse.
+    """
+    def __init__(self, failures=3, cooldown=30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at >= self.cooldown:
+                # Semiabierto: una petición de prueba; si falla se reabre el plazo completo
+                self._opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._count = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._count += 1
+            if self._count >= self.failures:
+                if self._opened_at is None:
+                    print(f"🔌 OSRM no responde ({self._count} fallos seguidos): cortocircuito {self.cooldown}s.")
+                self._opened_at = time.time()
+
+class OSRMClient:
+    """
+    Cliente HTTP para osrm-routed con conexiones keep-alive compartidas,
+    límite de peticiones en vuelo y reintentos con backoff exponencial + jitter.
+    Es seguro usarlo desde varios hilos a la vez.
+    """
+    def __init__(self, base_url="http://localhost:5001", profile="foot", max_in_flight=8,
+                 retries=3, backoff=0.5, timeout=10):
+        self.base_url = base_url.rstrip("/")
+        self.profile = profile
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # Un pool de conexiones del mismo tamaño que el límite de concurrencia
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+    def request(self, service, coords, timeout=None, **params):
+        """
+        GET /{service}/v1/{profile}/{coords}?{params}
+        coords: lista de strings "lon,lat".
+        Devuelve el JSON de OSRM (code == 'Ok') o lanza OSRMError.
+        """
+        url = f"{self.base_url}/{service}/v1/{self.profile}/{';'.join(coords)}"
+        if params:
+            # Montamos la query a mano: OSRM espera ';' y ',' sin escapar
+            url += "?" + "&".join(f"{k}={v}" for k, v in params.items())
+        last_error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Full jitter: evita que todos los hilos reintenten a la vez
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            try:
+                with self._slots:
+                    r = self.session.get(url, timeout=timeout or self.timeout)
+                if r.status_code == 429 or r.status_code >= 500:
+                    last_error = OSRMError(f"HTTP {r.status_code}")
+                    continue
+                data = r.json()
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                last_error = e
+                continue
+
+            code = data.get("code")
+            if code == "Ok":
+                return data
+            if code in NON_RETRYABLE_CODES:
+                raise OSRMRequestError(f"OSRM {code}: {data.get('message')}")
+            last_error = OSRMError(f"OSRM {code}: {data.get('message')}")
+
+        raise OSRMError(f"OSRM no responde tras {self.retries + 1} intentos: {last_error}")
+
+    def table(self, coords, sources=None, destinations=None, timeout=None, hints=None):
+        """hints: un hint de /nearest por coordenada ('' = que OSRM la snapee)."""
+        params = {}
+        if sources is not None:
+            params["sources"] = ";".join(str(i) for i in sources)
+        if destinations is not None:
+            params["destinations"] = ";".join(str(i) for i in destinations)
+        if hints is not None and any(hints):
+            params["hints"] = ";".join(hints)
+        return self.request("table", coords, timeout=timeout, **params)["durations"]
+
+    def route(self, coords, timeout=None, hints=None, **params):
+        if hints is not None and any(hints):
+            params["hints"] = ";".join(hints)
+        return self.request("route", coords, timeout=timeout, **params)["routes"]
+
+    def nearest(self, coord, timeout=None):
+        """Waypoint snapeado de una coordenada: {'hint', 'distance' (m), 'location': [lon, lat], ...}"""
+        return self.request("nearest", [coord], timeout=timeout, number=1)["waypoints"][0]
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import h3
+from services.isochrone_cache import osrm_fingerprint
+
+# Puntos sin id propio (locales, POIs sin place_id) se identifican por su celda H3 res 12 (~9 m)
+HINT_H3_RES = 12
+
+def point_key(lat, lon):
+    return f"pt:{h3.geo_to_h3(lat, lon, HINT_H3_RES)}"
+
+class HintCache:
+    """
+    Caché persistente (SQLite) de los hints de OSRM: dónde snapea cada centroide/POI y a qué
+    distancia. Se rellena con /nearest una sola vez; los hints se pasan luego a /table y /route
+    para que el servidor no vuelva a snapear. Claves: 'h3:<h3_id>', 'poi:<place_id>' o point_key().
+    Como los hints dependen del grafo, se invalida con la huella del dataset de OSRM.
+    """
+    def __init__(self, path, osrm_data_dir, profile="foot"):
+        self.path = path
+        self.profile = profile
+        self.fingerprint = osrm_fingerprint(osrm_data_dir, profile)
+        self._memory = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS hints (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                hint TEXT,
+                snap_m REAL,
+                snapped_lon REAL,
+                snapped_lat REAL,
+                created REAL
+            )
+        """)
+        with self._conn:
+            stale = self._conn.execute("DELETE FROM hints WHERE fingerprint != ?", (self.fingerprint,)).rowcount
+        if stale:
+            print(f"♻️ Caché de hints: {stale} entradas invalidadas (datos OSRM cambiados).")
+
+    def get_many(self, keys):
+        """{key: (hint, snap_m)} con lo que ya está en caché."""
+        found, missing = {}, []
+        with self._lock:
+            for k in keys:
+                if k in self._memory:
+                    found[k] = self._memory[k]
+                else:
+                    missing.append(k)
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for k, hint, snap_m in self._conn.execute(
+                    f"SELECT key, hint, snap_m FROM hints WHERE key IN ({marks}) AND fingerprint = ?",
+                    (*chunk, self.fingerprint)
+                ):
+                    found[k] = self._memory[k] = (hint, snap_m)
+        return found
+
+    def lookup(self, client, items, breaker=None):
+        """
+        items: [(key, lon, lat)]. Devuelve [(hint, snap_m)] en el mismo orden; lo que falta se
+        pide a /nearest (en paralelo) y se guarda. Si /nearest falla: ('', None), sin guardar.
+        breaker: CircuitBreaker opcional; con el circuito abierto no se pide nada más.
+        """
+        keys = [k for k, _, _ in items]
+        found = self.get_many(keys)
+        pending = {k: (lon, lat) for k, lon, lat in items if k not in found}
+
+        if pending:
+            def snap(item):
+                k, (lon, lat) = item
+                if breaker is not None and not breaker.allow():
+                    return k, None
+                try:
+                    wp = client.nearest(f"{lon},{lat}")
+                except Exception:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    return k, None
+                if breaker is not None:
+                    breaker.record_success()
+                return k, wp
+
+            now = time.time()
+            rows = []
+            with ThreadPoolExecutor(max_workers=client.max_in_flight) as pool:
+                for k, wp in pool.map(snap, pending.items()):
+                    if wp is None:
+                        continue
+                    found[k] = (wp["hint"], float(wp["distance"]))
+                    rows.append((k, self.fingerprint, wp["hint"], float(wp["distance"]),
+                                 wp["location"][0], wp["location"][1], now))
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany("INSERT OR REPLACE INTO hints VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                for k, _, hint, snap_m, _, _, _ in rows:
+                    self._memory[k] = (hint, snap_m)
+
+        return [found.get(k, ("", None)) for k in keys]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,206 @@
+import os
+import json
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Misma velocidad que el perfil foot.lua de OSRM (5 km/h)
+WALK_SPEED_MS = 5000 / 3600
+
+# Vías que no se pueden andar (el resto de 'highway' se considera peatonal)
+NON_WALKABLE = {"motorway", "motorway_link", "construction", "proposed", "abandoned",
+                "raceway", "bus_guideway", "escape", "busway"}
+NO_ACCESS = {"no", "private"}
+
+# Proyección equirectangular local (la misma aproximación que el fallback euclidiano del ETL)
+M_PER_DEG_LAT = 111132
+
+# Orígenes por llamada a dijkstra: cada uno devuelve una fila densa de N nodos (float64)
+ORIGIN_CHUNK = 4
+
+def _project(lons, lats, lat0):
+    return np.column_stack([
+        np.asarray(lons) * M_PER_DEG_LAT * np.cos(np.radians(lat0)),
+        np.asarray(lats) * M_PER_DEG_LAT
+    ])
+
+def _haversine(lon1, lat1, lon2, lat2):
+    R = 6371000
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lon2 - lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+def build_street_graph(pbf_path, bbox, out_dir):
+    """
+    Compila la red peatonal del PBF dentro de la bbox a un grafo CSR en disco:
+    indptr / indices / weights (segundos andando) + lon / lat de cada nodo, en .npy.
+    Se construye una vez por ciudad; luego se abre con StreetGraph (memory-mapped).
+    """
+    import osmium  # Solo hace falta para compilar, no para consultar
+
+    class WalkHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super(WalkHandler, self).__init__()
+            self.u, self.v = [], []
+            self.coords = {}
+
+        def inside(self, loc):
+            return (bbox['min_lon'] <= loc.lon <= bbox['max_lon'] and
+                    bbox['min_lat'] <= loc.lat <= bbox['max_lat'])
+
+        def way(self, w):
+            highway = w.tags.get('highway')
+            if highway is None or highway in NON_WALKABLE:
+                return
+            foot = w.tags.get('foot')
+            if foot in NO_ACCESS or (w.tags.get('access') in NO_ACCESS and foot not in ('yes', 'designated')):
+                return
+
+            prev = None
+            for n in w.nodes:
+                if not n.location.valid() or not self.inside(n.location):
+                    prev = None
+                    continue
+                self.coords[n.ref] = (n.location.lon, n.location.lat)
+                if prev is not None:
+                    self.u.append(prev)
+                    self.v.append(n.ref)
+                prev = n.ref
+
+    print(f"   🗺️ Leyendo red peatonal de {os.path.basename(pbf_path)}...")
+    handler = WalkHandler()
+    handler.apply_file(pbf_path, locations=True)
+    if not handler.u:
+        raise ValueError("No hay vías peatonales dentro de la bbox.")
+
+    # IDs de OSM -> índices compactos 0..N-1
+    osm_ids = np.fromiter(handler.coords.keys(), dtype=np.int64, count=len(handler.coords))
+    xy = np.array(list(handler.coords.values()), dtype=np.float64)
+    order = np.argsort(osm_ids)
+    osm_ids, xy = osm_ids[order], xy[order]
+    u = np.searchsorted(osm_ids, np.asarray(handler.u, dtype=np.int64))
+    v = np.searchsorted(osm_ids, np.asarray(handler.v, dtype=np.int64))
+
+    # float64: es el dtype con el que trabaja dijkstra, así el mmap se usa sin copiar
+    seconds = _haversine(xy[u, 0], xy[u, 1], xy[v, 0], xy[v, 1]) / WALK_SPEED_MS
+
+    # Andando no hay sentido único: aristas en las dos direcciones
+    src = np.concatenate([u, v])
+    dst = np.concatenate([v, u])
+    w = np.concatenate([seconds, seconds])
+    keep = src != dst
+    src, dst, w = src[keep], dst[keep], w[keep]
+
+    # Aristas repetidas (dos vías con el mismo tramo): nos quedamos con la más corta
+    order = np.lexsort((w, dst, src))
+    src, dst, w = src[order], dst[order], w[order]
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    src, dst, w = src[first], dst[first], w[first]
+
+    n_nodes = len(osm_ids)
+    # Mismo dtype para indptr e indices: así scipy no copia los arrays al abrirlos
+    indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=n_nodes), out=indptr[1:])
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "indptr.npy"), indptr)
+    np.save(os.path.join(out_dir, "indices.npy"), dst.astype(np.int32))
+    np.save(os.path.join(out_dir, "weights.npy"), w)
+    np.save(os.path.join(out_dir, "lon.npy"), xy[:, 0])
+    np.save(os.path.join(out_dir, "lat.npy"), xy[:, 1])
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"pbf": os.path.basename(pbf_path), "bbox": bbox, "nodes": int(n_nodes),
+                   "edges": int(len(dst)), "walk_speed_ms": WALK_SPEED_MS}, f, indent=2)
+
+    print(f"   ✅ Grafo guardado en {out_dir}: {n_nodes} nodos, {len(dst)} aristas.")
+    return out_dir
+
+class StreetGraph:
+    """
+    Grafo peatonal compilado por build_street_graph, abierto con mmap
+    (varios procesos comparten las mismas páginas en memoria).
+    """
+    def __init__(self, graph_dir):
+        self.graph_dir = graph_dir
+        load = lambda name: np.load(os.path.join(graph_dir, f"{name}.npy"), mmap_mode="r")
+        self.lon, self.lat = load("lon"), load("lat")
+        n = len(self.lon)
+        self.csr = csr_matrix((load("weights"), load("indices"), load("indptr")), shape=(n, n), copy=False)
+
+        self.lat0 = float(np.mean(self.lat))
+        self.tree = cKDTree(_project(self.lon, self.lat, self.lat0))
+
+    def snap(self, lons, lats):
+        """Nodo más cercano y distancia de snapping (metros) para cada punto."""
+        dist, idx = self.tree.query(_project(lons, lats, self.lat0))
+        return idx, dist
+
+    def durations(self, origins, destinations, limit):
+        """
+        origins: array (n, 2) lon/lat. destinations: array (n, k, 2) o lista de arrays (k_i, 2).
+        Dijkstra acotado a 'limit' segundos, en tandas de ORIGIN_CHUNK orígenes: de cada tanda
+        solo se guardan las columnas de sus destinos (nunca una matriz orígenes x nodos entera).
+        Devuelve, por origen, un array con los segundos a cada destino (NaN si no se alcanza).
+        """
+        origins = np.asarray(origins, dtype=np.float64)
+        o_idx, o_snap = self.snap(origins[:, 0], origins[:, 1])
+        destinations = [np.asarray(d, dtype=np.float64).reshape(-1, 2) for d in destinations]
+
+        results = []
+        for start in range(0, len(o_idx), ORIGIN_CHUNK):
+            stop = min(start + ORIGIN_CHUNK, len(o_idx))
+            dist = dijkstra(self.csr, directed=True, indices=o_idx[start:stop], limit=limit)
+            for i in range(start, stop):
+                dests = destinations[i]
+                d_idx, d_snap = self.snap(dests[:, 0], dests[:, 1])
+                # El tramo hasta/desde la red se hace andando en línea recta
+                secs = dist[i - start, d_idx] + (o_snap[i] + d_snap) / WALK_SPEED_MS
+                results.append(np.where(np.isfinite(secs), secs, np.nan))
+            del dist
+        return results
+
+    def nearest_source_times(self, sources, queries, limit=np.inf):
+        """
+        Dijkstra multi-origen: segundos andando desde cada punto de queries (array (m, 2) lon/lat)
+        hasta el más cercano de sources (array (s, 2)), con un solo recorrido del grafo.
+        Se añade un nodo virtual unido a los nodos de todas las fuentes (peso = su tramo de
+        snapping), así cada fuente arranca con su propio desfase. NaN si no se alcanza en 'limit'.
+        """
+        sources = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 2)
+        n = self.csr.shape[0]
+
+        s_idx, s_snap = self.snap(sources[:, 0], sources[:, 1])
+        # Varias fuentes en el mismo nodo: nos quedamos con el desfase menor
+        offsets = np.full(n, np.inf)
+        np.minimum.at(offsets, s_idx, s_snap / WALK_SPEED_MS)
+        seed_nodes = np.flatnonzero(np.isfinite(offsets))
+
+        indptr = np.concatenate([self.csr.indptr, [self.csr.indptr[-1] + len(seed_nodes)]])
+        indices = np.concatenate([self.csr.indices, seed_nodes.astype(self.csr.indices.dtype)])
+        weights = np.concatenate([self.csr.data, offsets[seed_nodes].astype(self.csr.data.dtype)])
+        augmented = csr_matrix((weights, indices, indptr), shape=(n + 1, n + 1))
+
+        dist = dijkstra(augmented, directed=True, indices=n, limit=limit)
+        q_idx, q_snap = self.snap(queries[:, 0], queries[:, 1])
+        secs = dist[q_idx] + q_snap / WALK_SPEED_MS
+        return np.where(np.isfinite(secs) & (secs <= limit), secs, np.nan)
+
+# Un grafo abierto por proceso (los workers del pool lo reutilizan entre lotes)
+_GRAPHS = {}
+
+def graph_batch_durations(graph_dir, origins, destinations, limit):
+    """Punto de entrada picklable para ProcessPoolExecutor."""
+    if graph_dir not in _GRAPHS:
+        _GRAPHS[graph_dir] = StreetGraph(graph_dir)
+    return _GRAPHS[graph_dir].durations(origins, destinations, limit)
+
+def graph_nearest_times(graph_dir, sources, queries, limit=np.inf):
+    """Punto de entrada picklable de StreetGraph.nearest_source_times (una categoría por proceso)."""
+    if graph_dir not in _GRAPHS:
+        _GRAPHS[graph_dir] = StreetGraph(graph_dir)
+    return _GRAPHS[graph_dir].nearest_source_times(sources, queries, limit)
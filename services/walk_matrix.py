@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import math
+from concurrent.futures import ThreadPoolExecutor
+import h3
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Segundos en uint16: 65535 (~18 h) nunca se alcanza andando dentro del radio
+MAX_SECONDS = np.iinfo(np.uint16).max
+
+# Los orígenes se agrupan por su padre en esta resolución (~49 hexágonos res 9):
+# comparten casi todos los destinos, así que los bloques /table salen densos.
+TILE_PARENT_RES = 7
+
+def _to_int_ids(h3_ids):
+    return np.array([h3.string_to_h3(str(h)) if isinstance(h, str) else int(h) for h in h3_ids], dtype=np.uint64)
+
+def _haversine(lon1, lat1, lon2, lat2):
+    R = 6371000
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lon2 - lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+def _blocks(sources, dests, max_cells):
+    """Trocea sources x dests en bloques con filas * columnas <= max_cells (límite de /table)."""
+    rows = min(len(sources), int(math.sqrt(max_cells)))
+    cols = max(1, max_cells // rows)
+    for i in range(0, len(sources), rows):
+        for j in range(0, len(dests), cols):
+            yield sources[i:i + rows], dests[j:j + cols]
+
+def build_walk_matrix(h3_ids, osrm, out_dir, radius_m=1500, max_table_size=100):
+    """
+    Tiempos andando entre centroides de hexágonos (res 9) a menos de radius_m en línea recta,
+    con llamadas /table muchos-a-muchos por bloques (orígenes agrupados por padre res 7).
+    Guarda una matriz CSR (filas/columnas = h3_ids ordenados como uint64) en .npy:
+    indptr / indices (int32) / seconds (uint16) + h3_ids.npy y meta.json.
+    osrm: OSRMClient (sus peticiones en vuelo marcan el paralelismo).
+    """
+    ids = np.unique(_to_int_ids(h3_ids))
+    n = len(ids)
+    strings = [h3.h3_to_string(int(h)) for h in ids]
+    latlon = np.array([h3.h3_to_geo(h) for h in strings])
+    lat, lon = latlon[:, 0], latlon[:, 1]
+    pos = {h: i for i, h in enumerate(strings)}
+
+    res = h3.h3_get_resolution(strings[0])
+    spacing = h3.edge_length(res, 'm') * math.sqrt(3)
+    # En el anillo k la celda más cercana está a k * spacing * √3/2 (lados del hexágono del anillo)
+    k = max(1, math.ceil(radius_m / (spacing * math.sqrt(3) / 2)))
+
+    # Orígenes por tesela y destinos candidatos: k-rings de la tesela dentro del universo
+    tiles = {}
+    for i, h in enumerate(strings):
+        tiles.setdefault(h3.h3_to_parent(h, TILE_PARENT_RES), []).append(i)
+    jobs = []
+    for members in tiles.values():
+        cand = set()
+        for i in members:
+            cand.update(h3.k_ring(strings[i], k))
+        dests = sorted(pos[c] for c in cand if c in pos)
+        jobs.extend(_blocks(np.array(members), np.array(dests), max_table_size ** 2))
+
+    def run(block):
+        src, dst = block
+        coords = [f"{lon[i]},{lat[i]}" for i in src] + [f"{lon[j]},{lat[j]}" for j in dst]
+        durations = osrm.table(coords, sources=range(len(src)), destinations=range(len(src), len(coords)))
+        secs = np.array(durations, dtype=np.float64).reshape(len(src), len(dst))
+        rr, cc = np.meshgrid(src, dst, indexing="ij")
+        keep = np.isfinite(secs) & (_haversine(lon[rr], lat[rr], lon[cc], lat[cc]) <= radius_m)
+        # La celda consigo misma siempre está (0 s) aunque OSRM no la "snapee"
+        keep |= rr == cc
+        secs = np.where(rr == cc, 0, secs)
+        return rr[keep], cc[keep], np.minimum(np.round(secs[keep]), MAX_SECONDS).astype(np.uint16)
+
+    print(f"   🧮 {n} hexágonos, radio {radius_m} m (k={k}): {len(jobs)} bloques /table...")
+    t0 = time.time()
+    rows, cols, secs = [], [], []
+    with ThreadPoolExecutor(max_workers=osrm.max_in_flight) as pool:
+        for b, (r, c, s) in enumerate(pool.map(run, jobs), 1):
+            rows.append(r)
+            cols.append(c)
+            secs.append(s)
+            if b % 200 == 0:
+                print(f"      {b}/{len(jobs)} bloques ({time.time() - t0:.0f}s)", end="\r")
+
+    rows, cols, secs = np.concatenate(rows), np.concatenate(cols), np.concatenate(secs)
+    order = np.lexsort((cols, rows))
+    # Mismo dtype para indptr e indices: así scipy no copia los arrays al abrirlos
+    idx_dtype = np.int32 if len(secs) < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(n + 1, dtype=idx_dtype)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "h3_ids.npy"), ids)
+    np.save(os.path.join(out_dir, "indptr.npy"), indptr)
+    np.save(os.path.join(out_dir, "indices.npy"), cols[order].astype(idx_dtype))
+    np.save(os.path.join(out_dir, "seconds.npy"), secs[order])
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"cells": int(n), "pairs": int(len(secs)), "radius_m": radius_m,
+                   "k": k, "h3_res": res, "profile": osrm.profile}, f, indent=2)
+
+    print(f"\n   ✅ Matriz guardada en {out_dir}: {len(secs)} pares ({len(secs) / n:.0f} por hexágono).")
+    return out_dir
+
+class WalkMatrix:
+    """
+    Matriz dispersa de tiempos andando hexágono -> hexágono (build_walk_matrix), abierta con mmap.
+    Los ids se pueden pasar como string H3 o como entero; se devuelven como uint64
+    (h3.h3_to_string para volver a string).
+    """
+    def __init__(self, matrix_dir):
+        self.matrix_dir = matrix_dir
+        load = lambda name: np.load(os.path.join(matrix_dir, f"{name}.npy"), mmap_mode="r")
+        self.h3_ids = load("h3_ids")
+        self.indptr, self.indices, self.seconds = load("indptr"), load("indices"), load("seconds")
+        with open(os.path.join(matrix_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.h3_ids)
+
+    @property
+    def csr(self):
+        n = len(self.h3_ids)
+        return csr_matrix((self.seconds, self.indices, self.indptr), shape=(n, n), copy=False)
+
+    def index(self, h3_ids):
+        """Posición de cada id en la matriz (-1 si no está)."""
+        ids = _to_int_ids(np.atleast_1d(h3_ids))
+        idx = np.searchsorted(self.h3_ids, ids)
+        idx = np.minimum(idx, len(self.h3_ids) - 1)
+        return np.where(self.h3_ids[idx] == ids, idx, -1)
+
+    def row(self, h3_id):
+        """(ids vecinos, segundos) desde un hexágono a todo lo que hay dentro del radio."""
+        i = self.index(h3_id)[0]
+        if i < 0:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint16)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.h3_ids[self.indices[start:end]], np.asarray(self.seconds[start:end])
+
+    def neighbourhood(self, h3_id, max_seconds):
+        """Como row() pero solo los hexágonos a menos de max_seconds andando."""
+        ids, secs = self.row(h3_id)
+        keep = secs <= max_seconds
+        return ids[keep], secs[keep]
+
+    def submatrix(self, h3_ids):
+        """CSR (len(h3_ids) x len(h3_ids)) con los tiempos entre esos hexágonos, en su orden."""
+        idx = self.index(h3_ids)
+        if (idx < 0).any():
+            raise KeyError(f"{int((idx < 0).sum())} hexágonos no están en la matriz")
+        return self.csr[idx][:, idx]
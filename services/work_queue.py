@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import sqlite3
+
+# Tiempo que un worker "posee" una unidad. Si muere sin terminarla, al caducar
+# el lease otra la recoge.
+DEFAULT_LEASE_S = 600
+MAX_ATTEMPTS = 3
+
+class LeaseLost(RuntimeError):
+    """La unidad ya no es de este worker (su lease caducó y la recogió otro)."""
+    pass
+
+class WorkQueue:
+    """
+    Cola local de unidades de trabajo en SQLite (WAL), compartida por varios procesos.
+    Cada unidad es un trozo de hexágonos pendientes de un trabajo (ciudad + umbrales);
+    pasa por pending -> leased -> done (o failed tras MAX_ATTEMPTS).
+    El estado 'done' es el marcador de completado: al relanzar, solo se reparte lo que falta.
+    """
+    def __init__(self, path, lease_s=DEFAULT_LEASE_S):
+        self.path = path
+        self.lease_s = lease_s
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # isolation_level=None: las transacciones las abrimos a mano (BEGIN IMMEDIATE)
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS work_units (
+                job TEXT,
+                unit INTEGER,
+                payload TEXT,
+                n_items INTEGER,
+                status TEXT DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                finished_at REAL,
+                PRIMARY KEY (job, unit)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_units_status ON work_units (status, job);")
+
+    def has_open_units(self, job):
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM work_units WHERE job = ? AND status IN ('pending', 'leased')", (job,)
+        ).fetchone()
+        return row[0] > 0
+
+    def enqueue(self, job, items, unit_size=500):
+        """Trocea items (lista de valores JSON-serializables) en unidades nuevas del trabajo."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            start = self._conn.execute("SELECT COALESCE(MAX(unit) + 1, 0) FROM work_units WHERE job = ?", (job,)).fetchone()[0]
+            rows = [
+                (job, start + n, json.dumps(items[i:i + unit_size]), len(items[i:i + unit_size]))
+                for n, i in enumerate(range(0, len(items), unit_size))
+            ]
+            self._conn.executemany("INSERT INTO work_units (job, unit, payload, n_items) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def lease(self, jobs, worker):
+        """
+        Reserva una unidad pendiente (o con el lease caducado) de alguno de los trabajos.
+        Devuelve (job, unit, items, attempts) o None si no queda nada que repartir.
+        """
+        now = time.time()
+        marks = ",".join("?" * len(jobs))
+        # BEGIN IMMEDIATE toma el lock de escritura: dos procesos no pueden llevarse la misma unidad
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(f"""
+                SELECT job, unit, payload, attempts FROM work_units
+                WHERE job IN ({marks})
+                  AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))
+                ORDER BY attempts, unit
+                LIMIT 1
+            """, (*jobs, now)).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            job, unit, payload, attempts = row
+            self._conn.execute(
+                "UPDATE work_units SET status = 'leased', worker = ?, lease_until = ? WHERE job = ? AND unit = ?",
+                (worker, now + self.lease_s, job, unit)
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return job, unit, json.loads(payload), attempts
+
+    def renew(self, job, unit, worker):
+        """
+        Latido: alarga el lease de una unidad que sigue siendo de este worker.
+        Devuelve False si la unidad ya no es suya (el lease caducó y otro la recogió).
+        """
+        cur = self._conn.execute(
+            "UPDATE work_units SET lease_until = ? WHERE job = ? AND unit = ? AND status = 'leased' AND worker = ?",
+            (time.time() + self.lease_s, job, unit, worker)
+        )
+        return cur.rowcount > 0
+
+    def complete(self, job, unit, worker):
+        """Marca la unidad como hecha si sigue siendo de este worker (devuelve False si no)."""
+        cur = self._conn.execute(
+            "UPDATE work_units SET status = 'done', lease_until = NULL, error = NULL, finished_at = ? "
+            "WHERE job = ? AND unit = ? AND status = 'leased' AND worker = ?",
+            (time.time(), job, unit, worker)
+        )
+        return cur.rowcount > 0
+
+    def fail(self, job, unit, worker, error):
+        """
+        Devuelve la unidad a la cola; tras MAX_ATTEMPTS intentos queda como 'failed'.
+        Si la unidad ya la tiene otro worker no se toca (devuelve False).
+        """
+        cur = self._conn.execute("""
+            UPDATE work_units
+            SET attempts = attempts + 1, error = ?, lease_until = NULL,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+            WHERE job = ? AND unit = ? AND status = 'leased' AND worker = ?
+        """, (str(error)[:500], MAX_ATTEMPTS, job, unit, worker))
+        return cur.rowcount > 0
+
+    def reclaim_orphans(self, jobs):
+        """
+        Devuelve a 'pending' las unidades reservadas por procesos que ya no existen
+        (worker = 'nombre@pid'), sin esperar a que caduque su lease. Cuenta como un intento
+        fallido: una unidad que tumba al proceso (segfault, OOM) acaba 'failed' igual que en fail().
+        """
+        marks = ",".join("?" * len(jobs))
+        workers = [w for (w,) in self._conn.execute(
+            f"SELECT DISTINCT worker FROM work_units WHERE status = 'leased' AND job IN ({marks})", tuple(jobs)
+        )]
+        orphans = []
+        for w in workers:
+            try:
+                os.kill(int(w.rsplit("@", 1)[1]), 0)
+            except (IndexError, ValueError):
+                continue
+            except ProcessLookupError:
+                orphans.append(w)
+            except PermissionError:
+                pass  # Existe, pero es de otro usuario
+        for w in orphans:
+            self._conn.execute("""
+                UPDATE work_units
+                SET attempts = attempts + 1, error = ?, worker = NULL, lease_until = NULL,
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE status = 'leased' AND worker = ?
+            """, (f"Proceso {w} terminado sin completar la unidad", MAX_ATTEMPTS, w))
+        return len(orphans)
+
+    def progress(self, jobs):
+        """{job: {status: (unidades, items)}}"""
+        marks = ",".join("?" * len(jobs))
+        out = {job: {} for job in jobs}
+        for job, status, units, items in self._conn.execute(f"""
+            SELECT job, status, COUNT(*), COALESCE(SUM(n_items), 0) FROM work_units
+            WHERE job IN ({marks}) GROUP BY job, status
+        """, tuple(jobs)):
+            out[job][status] = (units, items)
+        return out
+
+    def close(self):
+        self._conn.close()